@@ -10,11 +10,16 @@ config_name = os.environ.get('FLASK_CONFIG', 'development')
 cfg = os.path.join(os.getcwd(), 'config', config_name + '.py')
 app.config.from_pyfile(cfg)
 
+# Allow request globals like g.passwd to be evaluated lazily
+from .credentials import RequestGlobals
+app.app_ctx_globals_class = RequestGlobals
+
 # Create a blueprint
 api = Blueprint('api', __name__)
 # Import the endpoints belonging to this blueprint
 from . import endpoints
 from . import errors
+from . import compression
 
 # register blueprints
 app.register_blueprint(api, url_prefix='/bigdata/api/v1')
@@ -0,0 +1,106 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """Bounded thread safe LRU cache with optional expiration of entries
+
+    Entries are evicted when the cache is full, least recently used first.
+    Expired entries are dropped when they are read and, so that they do
+    not hold slots that live entries could use, by set() once the earliest
+    expiration time has passed. Hit and miss counters are available
+    through info().
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        # Earliest expiration time of the stored entries, None if none expires
+        self._next_expiration = None
+
+    def get(self, key, default=None):
+        """Get the value stored for key if it is present and not expired"""
+        with self._lock:
+            try:
+                value, expires = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and time.time() >= expires:
+                self.expirations += 1
+                self.misses += 1
+                return default
+            # Re-insert it so it becomes the most recently used entry
+            self._entries[key] = (value, expires)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, expires=None):
+        """Store value under key
+
+        expires is an absolute timestamp, if not given the entry expires
+        after the default ttl of the cache (if any).
+        """
+        if expires is None and self.ttl is not None:
+            expires = time.time() + self.ttl
+        if expires is not None and time.time() >= expires:
+            return
+        with self._lock:
+            self._purge()
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires)
+            if expires is not None and (self._next_expiration is None or
+                                        expires < self._next_expiration):
+                self._next_expiration = expires
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def purge(self):
+        """Remove the expired entries"""
+        with self._lock:
+            self._purge()
+
+    def _purge(self):
+        now = time.time()
+        if self._next_expiration is None or now < self._next_expiration:
+            return
+        self._next_expiration = None
+        for key, (_, expires) in list(self._entries.items()):
+            if expires is None:
+                continue
+            if now >= expires:
+                del self._entries[key]
+                self.expirations += 1
+            elif self._next_expiration is None or expires < self._next_expiration:
+                self._next_expiration = expires
+
+    def invalidate(self, key):
+        """Remove the entry stored under key"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Remove all the entries"""
+        with self._lock:
+            self._entries.clear()
+            self._next_expiration = None
+
+    def info(self):
+        """Usage statistics of the cache"""
+        with self._lock:
+            self._purge()
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions,
+                    'expirations': self.expirations,
+                    'size': len(self._entries), 'maxsize': self.maxsize}
+
+    def __len__(self):
+        return len(self._entries)
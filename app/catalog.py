@@ -0,0 +1,265 @@
+import json
+import time
+
+import kvstore
+import registry
+
+from . import app
+from . import consul
+from . import snapshot
+from .cache import LRUCache
+from .snapshot import Record
+
+
+def product_dn(name, version):
+    return '{}/{}/{}'.format(registry.TMPLPREFIX, name, version)
+
+
+class OptionsSchema(object):
+    """Compiled options document of a product
+
+    The document has the options grouped as required, optional and
+    advanced, each one with its default value, plus their descriptions.
+    It is parsed once and the merged defaults, required names and expected
+    types are precomputed, so validating the options of a launch is only
+    a few dict lookups.
+    """
+
+    GROUPS = ('required', 'optional', 'advanced')
+
+    def __init__(self, text):
+        self.document = json.loads(text)
+        self.defaults = {}
+        for group in self.GROUPS:
+            self.defaults.update(self.document.get(group, {}))
+        self.required = sorted(self.document.get('required', {}))
+        self.types = {k: _option_type(v) for k, v in self.defaults.items()}
+
+    def validate(self, options):
+        """Raise registry.InvalidOptionsError if the options are invalid
+
+        Required options must be present. Options with a numeric default
+        must be numbers or numeric strings (eg. "2"), options with a text
+        default text or numbers.
+        """
+        if not isinstance(options, dict):
+            raise registry.InvalidOptionsError('options must be an object')
+        missing = [k for k in self.required if k not in options]
+        if missing:
+            raise registry.InvalidOptionsError(
+                'missing required options: {}'.format(', '.join(missing)))
+        for k, v in options.items():
+            expected = self.types.get(k)
+            if expected is not None and _coerce(v, expected) is None:
+                raise registry.InvalidOptionsError(
+                    'option {} must be a {}'.format(k, expected))
+
+    def merge(self, options):
+        """Validated options completed with the defaults
+
+        Numeric strings given for numeric options are converted to numbers,
+        so templates can do arithmetic with them (eg. range(opts['size'])).
+        """
+        self.validate(options)
+        merged = dict(self.defaults)
+        for k, v in options.items():
+            expected = self.types.get(k)
+            merged[k] = v if expected is None else _coerce(v, expected)
+        return merged
+
+
+def _option_type(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, long, float)):
+        return 'number'
+    if isinstance(value, basestring):
+        return 'string'
+    return None
+
+
+def _coerce(value, expected):
+    """value as an option of the expected type, None if it is not valid"""
+    kind = _option_type(value)
+    if kind is None:
+        return None
+    if kind == 'number' or expected == 'string':
+        return value
+    for number in (int, float):
+        try:
+            return number(value)
+        except ValueError:
+            pass
+    return None
+
+
+class ProductRecord(Record):
+    """In-memory product document with the interface of registry.Product"""
+
+    __serializable__ = registry.Product.__serializable__
+
+    @property
+    def schema(self):
+        """Options schema, compiled on first use and kept with the record"""
+        schema = self.__dict__.get('_schema')
+        if schema is None:
+            schema = self.__dict__['_schema'] = OptionsSchema(self.options)
+        return schema
+
+    @property
+    def name(self):
+        return registry.parse_next_to_last_field(self.dn)
+
+    def to_dict(self):
+        data = {k: self.get(k) for k in self.__serializable__}
+        data.update(dn=self.dn, name=self.name)
+        return data
+
+
+class ProductCache(object):
+    """Read-through cache of product documents
+
+    A product document (every key below products/<name>/<version>) is read
+    with a single recursive request and kept together with the Consul index
+    of that read. Entries are trusted for `ttl` seconds, then they are
+    revalidated with a keys-only request and only read again when the index
+    changed, which is how changes made through other workers are noticed.
+    The PUT handlers of this worker invalidate the entries they modify.
+    """
+
+    def __init__(self, ttl=30, maxsize=256):
+        self.ttl = ttl
+        self.revalidations = 0
+        self._entries = LRUCache(maxsize=maxsize)
+
+    def get(self, name, version):
+        """Get the product document, reading it from Consul if needed"""
+        dn = product_dn(name, version)
+        now = time.time()
+        entry = self._entries.get(dn)
+        if entry is not None:
+            (product, index, checked) = entry
+            if now - checked < self.ttl:
+                return product
+            self.revalidations += 1
+            _, current = consul.read(dn + '/', recurse=True, keys=True)
+            if current == index:
+                self._entries.set(dn, (product, index, now))
+                return product
+        (product, index) = self._load(dn)
+        self._entries.set(dn, (product, index, now))
+        return product
+
+    def invalidate(self, name, version):
+        """Drop the cached document after the product has been modified"""
+        self._entries.invalidate(product_dn(name, version))
+
+    def info(self):
+        info = self._entries.info()
+        info['revalidations'] = self.revalidations
+        return info
+
+    def _load(self, dn):
+        entries, index = consul.read(dn + '/', recurse=True)
+        if not entries:
+            raise kvstore.KeyDoesNotExist('Product {} does not exist'.format(dn))
+        attributes = {e['Key'][len(dn) + 1:]: e['Value'] for e in entries}
+        return ProductRecord(dn, attributes, index), index
+
+
+products = ProductCache(ttl=app.config.get('PRODUCT_CACHE_TTL', 30))
+
+
+# Index of the registered products, outside products/ so that reading it
+# does not read the templates and orchestrators below that prefix
+CATALOG_INDEX_KEY = 'catalog/products'
+# Product keys copied to the index for each version
+INDEXED_FIELDS = ('description', 'logo_url')
+
+
+class ProductIndex(object):
+    """Product name -> version -> basic metadata, stored as one JSON key
+
+    Listing the products or the versions of a product is one read of the
+    index instead of reading every registered version. The index is kept
+    up to date by the handlers that register, modify or delete products,
+    using check-and-set writes so concurrent updates from other workers
+    are not lost. It is rebuilt from the registry when it does not exist
+    yet and can be rebuilt at any time with rebuild() if it drifts.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.rebuilds = 0
+
+    def get(self):
+        """Get the index, rebuilding it if it does not exist"""
+        (catalog, _) = self._read()
+        if catalog is None:
+            catalog = self.rebuild()
+        return catalog
+
+    def versions(self, name):
+        return sorted(self.get().get(name, {}))
+
+    def add(self, name, version, **fields):
+        """Add or update a product version in the index"""
+        def update(catalog):
+            metadata = catalog.setdefault(name, {}).setdefault(version, {})
+            metadata.update((k, v) for k, v in fields.items()
+                            if k in INDEXED_FIELDS)
+        self._update(update)
+
+    def remove(self, name, version):
+        """Remove a product version from the index"""
+        def update(catalog):
+            versions = catalog.get(name, {})
+            versions.pop(version, None)
+            if not versions:
+                catalog.pop(name, None)
+        self._update(update)
+
+    def rebuild(self):
+        """Build the index again from the products in the registry
+
+        The index is written with check-and-set against the version read
+        before the registry, so a product registered or deleted by another
+        worker in between makes the rebuild start again instead of being
+        lost.
+        """
+        while True:
+            (_, index) = self._read()
+            entries, _ = consul.read(registry.TMPLPREFIX + '/', recurse=True)
+            catalog = {}
+            for e in entries:
+                fields = e['Key'][len(registry.TMPLPREFIX) + 1:].split('/')
+                if len(fields) != 3:
+                    continue
+                (name, version, field) = fields
+                metadata = catalog.setdefault(name, {}).setdefault(version, {})
+                if field in INDEXED_FIELDS:
+                    metadata[field] = e['Value']
+            if consul.cas(self.key, json.dumps(catalog), index):
+                self.rebuilds += 1
+                return catalog
+
+    def _read(self):
+        entries, consul_index = consul.read(self.key)
+        snapshot.record_index(consul_index)
+        if not entries:
+            return None, 0
+        return json.loads(entries[0]['Value']), entries[0]['ModifyIndex']
+
+    def _update(self, update):
+        while True:
+            (catalog, index) = self._read()
+            if catalog is None:
+                # Rebuilt from the registry, which already has the change
+                self.rebuild()
+                return
+            update(catalog)
+            if consul.cas(self.key, json.dumps(catalog), index):
+                return
+
+
+product_index = ProductIndex(CATALOG_INDEX_KEY)
@@ -0,0 +1,81 @@
+import zlib
+
+from flask import request
+
+from . import api, app
+from .cache import LRUCache
+
+COMPRESS_MIN_SIZE = app.config.get('COMPRESS_MIN_SIZE', 1024)
+COMPRESS_LEVEL = app.config.get('COMPRESS_LEVEL', 6)
+
+# Product documents only change through their PUT handlers, which change
+# their ETag, so their compressed bodies can be reused by (etag, encoding)
+CACHED_ENDPOINTS = ('api.get_product', 'api.get_product_template',
+                    'api.get_product_options', 'api.get_product_orchestrator',
+                    'api.get_product_logo_url')
+compressed_bodies = LRUCache(maxsize=app.config.get('COMPRESS_CACHE_SIZE', 256))
+
+# wbits of each content coding: gzip header or zlib header (HTTP deflate)
+ENCODINGS = (('gzip', 16 + zlib.MAX_WBITS), ('deflate', zlib.MAX_WBITS))
+
+
+def negotiate():
+    """Content coding to use for the current request, None for identity"""
+    return request.accept_encodings.best_match([e for e, _ in ENCODINGS])
+
+
+def compressor(encoding):
+    return zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, dict(ENCODINGS)[encoding])
+
+
+def compress(data, encoding):
+    c = compressor(encoding)
+    return c.compress(data) + c.flush()
+
+
+def compress_stream(chunks, encoding):
+    """Compress the chunks of a streamed response as they are produced"""
+    c = compressor(encoding)
+    for chunk in chunks:
+        data = c.compress(chunk)
+        if data:
+            yield data
+    yield c.flush()
+
+
+@api.after_request
+def compress_response(response):
+    """Compress the response with gzip or deflate when the client accepts it
+
+    Streamed responses (listings) are always compressed, as they are sent,
+    other responses only when they are at least COMPRESS_MIN_SIZE bytes.
+    Event streams are left alone, compression would hold their events back.
+    conditional() already gives a different ETag to each content coding.
+    """
+    if request.method not in ('GET', 'HEAD') or response.status_code not in (200, 304):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate()
+    if (encoding is None or response.status_code != 200 or
+            response.direct_passthrough or 'Content-Encoding' in response.headers or
+            response.mimetype == 'text/event-stream'):
+        return response
+
+    if response.is_streamed:
+        response.response = compress_stream(response.iter_encoded(), encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return response
+        etag, _ = response.get_etag()
+        key = (etag, encoding)
+        cacheable = etag is not None and request.endpoint in CACHED_ENDPOINTS
+        body = compressed_bodies.get(key) if cacheable else None
+        if body is None:
+            body = compress(data, encoding)
+            if cacheable:
+                compressed_bodies.set(key, body)
+        response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    return response
@@ -0,0 +1,221 @@
+import base64
+
+import kvstore
+
+from . import app
+from . import outbound
+
+CONSUL_ENDPOINT = app.config.get('CONSUL_ENDPOINT')
+# The transaction API lives next to the KV API: /v1/kv -> /v1/txn
+TXN_ENDPOINT = CONSUL_ENDPOINT.rsplit('/', 1)[0] + '/txn'
+# Maximum number of operations Consul accepts in a single transaction
+TXN_MAX_OPERATIONS = 64
+SESSION_ENDPOINT = CONSUL_ENDPOINT.rsplit('/', 1)[0] + '/session'
+
+
+class Client(kvstore.Client):
+    """kvstore.Client that sends its requests through the pooled sessions"""
+
+    def _url(self, k):
+        return '{}/{}'.format(self.endpoint, k.lstrip('/'))
+
+    def set(self, k, v):
+        """Add or update a key, value pair to the database"""
+        r = outbound.put(self._url(k), data=str(v))
+        if r.status_code != 200 or r.json() is not True:
+            raise kvstore.KVStoreError('PUT returned {}'.format(r.status_code))
+
+    def get(self, k, wait=False, wait_index=False, timeout='5m'):
+        """Get the value of a given key"""
+        params = {}
+        kwargs = {}
+        if wait:
+            params['index'] = wait_index
+            params['wait'] = timeout
+            kwargs['timeout'] = _blocking_timeout(timeout)
+        r = outbound.get(self._url(k), params=params, **kwargs)
+        if r.status_code == 404:
+            raise kvstore.KeyDoesNotExist('Key ' + k + ' does not exist')
+        if r.status_code != 200:
+            raise kvstore.KVStoreError('GET returned {}'.format(r.status_code))
+        value = r.json()[0]['Value']
+        return base64.b64decode(value) if value else ''
+
+    def recurse(self, k, wait=False, wait_index=None, timeout='5m'):
+        """Recursively get the tree below the given key"""
+        params = {'recurse': 'true'}
+        kwargs = {}
+        if wait:
+            params['wait'] = timeout
+            params['index'] = wait_index or self.index(k, recursive=True)
+            kwargs['timeout'] = _blocking_timeout(timeout)
+        r = outbound.get(self._url(k), params=params, **kwargs)
+        if r.status_code == 404:
+            raise kvstore.KeyDoesNotExist('Key ' + k + ' does not exist')
+        if r.status_code != 200:
+            raise kvstore.KVStoreError('GET returned {}'.format(r.status_code))
+        return {e['Key']: base64.b64decode(e['Value']) if e['Value'] else ''
+                for e in r.json()}
+
+    def index(self, k, recursive=False):
+        """Get the current index of the key or the subtree"""
+        params = {'recurse': ''} if recursive else {}
+        r = outbound.get(self._url(k), params=params)
+        return r.headers['X-Consul-Index']
+
+    def delete(self, k, recursive=False):
+        """Delete a given key or recursively delete the tree below it"""
+        params = {'recurse': ''} if recursive else {}
+        r = outbound.delete(self._url(k), params=params)
+        if r.status_code != 200:
+            raise kvstore.KVStoreError('DELETE returned {}'.format(r.status_code))
+
+
+kv = Client(CONSUL_ENDPOINT)
+
+
+def read(key, recurse=False, keys=False, index=None, wait=None):
+    """Read a key or a subtree returning (entries, index)
+
+    Unlike kvstore.Client.get() this keeps the metadata of every entry
+    (ModifyIndex, CreateIndex, Session...) and returns the X-Consul-Index
+    of the response, which is what is needed to detect changes and to run
+    blocking queries (index and wait). Values are already decoded.
+
+    When keys is True only the list of key names is returned. A missing
+    key or subtree returns an empty list instead of raising.
+    """
+    url = '{}/{}'.format(CONSUL_ENDPOINT, key.lstrip('/'))
+    params = {}
+    if recurse:
+        params['recurse'] = 'true'
+    if keys:
+        params['keys'] = 'true'
+    kwargs = {}
+    if index is not None:
+        params['index'] = index
+        params['wait'] = wait or '5m'
+        kwargs['timeout'] = _blocking_timeout(params['wait'])
+    r = outbound.get(url, params=params, **kwargs)
+    consul_index = int(r.headers.get('X-Consul-Index', 0))
+    if r.status_code == 404:
+        return [], consul_index
+    if r.status_code != 200:
+        raise kvstore.KVStoreError('GET returned {}'.format(r.status_code))
+    entries = r.json()
+    if not keys:
+        for e in entries:
+            e['Value'] = base64.b64decode(e['Value']) if e['Value'] else ''
+    return entries, consul_index
+
+
+def cas(key, value, index):
+    """Set key only if its ModifyIndex is still index
+
+    With index 0 the key is only created if it does not exist yet. Returns
+    False when the key was modified in between, the caller should read it
+    again and retry.
+    """
+    url = '{}/{}'.format(CONSUL_ENDPOINT, key.lstrip('/'))
+    r = outbound.put(url, data=str(value), params={'cas': index})
+    if r.status_code != 200:
+        raise kvstore.KVStoreError('PUT returned {}'.format(r.status_code))
+    return r.json() is True
+
+
+def acquire(key, value, session):
+    """Try to lock key with the given session, True if it was acquired"""
+    url = '{}/{}'.format(CONSUL_ENDPOINT, key.lstrip('/'))
+    r = outbound.put(url, data=str(value), params={'acquire': session})
+    if r.status_code != 200:
+        raise kvstore.KVStoreError('PUT returned {}'.format(r.status_code))
+    return r.json() is True
+
+
+def release(key, session):
+    """Release the lock on key held by the given session"""
+    url = '{}/{}'.format(CONSUL_ENDPOINT, key.lstrip('/'))
+    r = outbound.put(url, params={'release': session})
+    if r.status_code != 200:
+        raise kvstore.KVStoreError('PUT returned {}'.format(r.status_code))
+    return r.json() is True
+
+
+def create_session(name, ttl):
+    """Create a session that releases its locks when it is invalidated"""
+    r = outbound.put(SESSION_ENDPOINT + '/create',
+                     json={'Name': name, 'TTL': ttl, 'Behavior': 'release'})
+    if r.status_code != 200:
+        raise kvstore.KVStoreError('Session create returned {}'
+                                   .format(r.status_code))
+    return r.json()['ID']
+
+
+def renew_session(session):
+    """Renew the TTL of a session, False if it does not exist anymore"""
+    r = outbound.put('{}/renew/{}'.format(SESSION_ENDPOINT, session))
+    if r.status_code == 404:
+        return False
+    if r.status_code != 200:
+        raise kvstore.KVStoreError('Session renew returned {}'
+                                   .format(r.status_code))
+    return True
+
+
+def txn(operations):
+    """Apply a list of KV operations atomically using the transaction API
+
+    Each operation is a dict like {'Verb': 'set', 'Key': k, 'Value': v}
+    with the value already base64 encoded. Consul rolls back the whole
+    transaction if any of them fails.
+    """
+    r = outbound.put(TXN_ENDPOINT, json=[{'KV': op} for op in operations])
+    if r.status_code != 200:
+        raise kvstore.KVStoreError('Transaction returned {}: {}'
+                                   .format(r.status_code, r.text))
+    return r.json().get('Results') or []
+
+
+def save(kvinfo, last=()):
+    """Write a dict of keys with as few transactions as possible
+
+    Keys are written in transactions of up to TXN_MAX_OPERATIONS, so each
+    chunk becomes visible at once. The keys in `last` go in the final
+    transaction, which is useful to write a marker key (eg. status) only
+    once everything else is in place.
+    """
+    keys = sorted(k for k in kvinfo if k not in last)
+    keys.extend(k for k in last if k in kvinfo)
+    operations = [{'Verb': 'set', 'Key': k.lstrip('/'),
+                   'Value': base64.b64encode(str(kvinfo[k]))}
+                  for k in keys]
+    for i in range(0, len(operations), TXN_MAX_OPERATIONS):
+        txn(operations[i:i + TXN_MAX_OPERATIONS])
+
+
+def duration(value):
+    """Seconds of a Consul duration like 500ms, 30s or 5m"""
+    for unit, seconds in (('ms', 0.001), ('s', 1), ('m', 60), ('h', 3600)):
+        if value.endswith(unit):
+            return float(value[:-len(unit)]) * seconds
+    raise ValueError('Invalid duration: {}'.format(value))
+
+
+def delete_trees(prefixes):
+    """Recursively delete the given prefixes with as few requests as possible
+
+    Each prefix is one delete-tree operation, they are sent in transactions
+    of up to TXN_MAX_OPERATIONS.
+    """
+    operations = [{'Verb': 'delete-tree', 'Key': prefix.lstrip('/')}
+                  for prefix in prefixes]
+    for i in range(0, len(operations), TXN_MAX_OPERATIONS):
+        txn(operations[i:i + TXN_MAX_OPERATIONS])
+
+
+def _blocking_timeout(wait):
+    """Client timeout for a blocking query that waits up to `wait`
+
+    Consul adds a random jitter of up to wait/16 to the wait time.
+    """
+    return duration(wait) * 17 / 16 + outbound.pool.timeout
@@ -0,0 +1,118 @@
+import os
+import threading
+import time
+
+from flask.ctx import _AppCtxGlobals
+from keyczar.keyczar import Crypter
+
+from . import app
+
+
+class Keyring(object):
+    """Process wide keyczar Crypter that follows key rotations
+
+    The keyset is read from disk the first time it is needed and then shared
+    by all the requests served by this worker. A daemon thread checks the key
+    directory every `interval` seconds and, when the keyset changes, reads
+    the new one and swaps it in with a single assignment, so requests in
+    flight keep using the Crypter they already got.
+    """
+
+    def __init__(self, location, interval=60):
+        self.location = location
+        self.interval = interval
+        self.reloads = 0
+        self._crypter = None
+        self._signature = None
+        self._lock = threading.Lock()
+        self._watcher = None
+
+    @property
+    def crypter(self):
+        """Current Crypter, loading the keyset on first use"""
+        crypter = self._crypter
+        if crypter is None:
+            crypter = self.reload(force=False)
+        return crypter
+
+    def decrypt(self, ciphertext):
+        """Decrypt a ciphertext with the current keyset"""
+        return self.crypter.Decrypt(ciphertext)
+
+    def reload(self, force=True):
+        """Read the keyset from disk and swap it in
+
+        When force is False the keyset is only read if the key directory
+        changed since the last load.
+        """
+        with self._lock:
+            signature = self._keyset_signature()
+            if force or signature != self._signature:
+                crypter = Crypter.Read(self.location)
+                self._crypter = crypter
+                self._signature = signature
+                self.reloads += 1
+            self._start_watcher()
+            return self._crypter
+
+    def _keyset_signature(self):
+        """Modification times of the key directory and its metadata
+
+        Adding a key changes the directory and promoting or revoking one
+        rewrites the meta file, so together they detect any rotation.
+        """
+        meta = os.path.join(self.location, 'meta')
+        return (os.stat(self.location).st_mtime, os.stat(meta).st_mtime)
+
+    def _start_watcher(self):
+        # Started lazily so that forked workers get their own watcher
+        if self._watcher is not None or not self.interval:
+            return
+        self._watcher = threading.Thread(target=self._watch)
+        self._watcher.daemon = True
+        self._watcher.start()
+
+    def _watch(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.reload(force=False)
+            except Exception as e:
+                # Keep serving with the old keyset until the new one is valid
+                app.logger.error('Unable to reload keyset {}: {}'
+                                 .format(self.location, e))
+
+
+class RequestGlobals(_AppCtxGlobals):
+    """Flask g object that supports attributes evaluated on first access
+
+    g.defer('passwd', keyring.decrypt, ciphertext) makes g.passwd call
+    keyring.decrypt(ciphertext) the first time a handler reads it and keeps
+    the result for the rest of the request, so handlers that never read the
+    attribute never pay for it.
+    """
+
+    def defer(self, name, function, *args):
+        """Set name to the value returned by function(*args) when first read"""
+        self.__dict__.pop(name, None)
+        self.__dict__.setdefault('_deferred', {})[name] = (function, args)
+
+    def __getattr__(self, name):
+        # Only called when the attribute has not been set or evaluated yet
+        deferred = self.__dict__.get('_deferred', {})
+        if name not in deferred:
+            raise AttributeError(name)
+        function, args = deferred.pop(name)
+        value = function(*args)
+        setattr(self, name, value)
+        return value
+
+    def get(self, name, default=None):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            return default
+
+    def __contains__(self, item):
+        return (item in self.__dict__ or
+                item in self.__dict__.get('_deferred', {}))
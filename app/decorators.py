@@ -2,20 +2,24 @@ import base64
 import functools
 import hashlib
 import time
-import uuid
-import threading
 
-from flask import request, make_response, g, jsonify, url_for, \
-                  copy_current_request_context
-from keyczar.keyczar import Crypter
+from flask import request, make_response, g, jsonify, url_for
 
 from . import app
-
-import kvstore
+from . import jobs
+from . import workers
+from .cache import LRUCache
+from .compression import negotiate
+from .credentials import Keyring
 
 KEYS = app.config.get('SECRET_KEYS')
 IGNORE_AUTH = app.config.get('IGNORE_AUTH')
 
+keyring = Keyring(KEYS,
+                  interval=app.config.get('SECRET_KEYS_RELOAD_INTERVAL', 60))
+# Tokens already verified: token_cache.info() reports hits and misses
+token_cache = LRUCache(maxsize=app.config.get('TOKEN_CACHE_SIZE', 1024))
+
 
 def restricted(role='ROLE_USER'):
     def decorator(f):
@@ -26,24 +30,19 @@ def restricted(role='ROLE_USER'):
             if token is None:
                 return _no_token()
 
-            if _is_token_signature_valid(token):
-                fields = token.split(':')
-
-                username = base64.b64decode(fields[0])
-                g.user = username
-
-                passwd_encrypted = fields[1]
-                crypter = Crypter.Read(KEYS)
-                passwd = crypter.Decrypt(passwd_encrypted)
-                g.passwd = passwd
-
-                token_role = base64.b64decode(fields[2])
-                g.role = token_role
+            credentials = token_cache.get(token)
+            if credentials is None:
+                if not _is_token_signature_valid(token):
+                    return _unauthorized()
+                credentials = _read_token(token)
+                # Already expired tokens are not stored by the cache
+                token_cache.set(token, credentials, expires=credentials[3])
 
-                #expires = time.localtime(int(fields[3])/1000)
-                expires = int(fields[3])/1000
-            else:
-                return _unauthorized()
+            (username, token_role, passwd_encrypted, expires) = credentials
+            g.user = username
+            # Only decrypted if the handler reads g.passwd
+            g.defer('passwd', keyring.decrypt, passwd_encrypted)
+            g.role = token_role
 
             if token_role != role:
                 return _invalid_role()
@@ -59,10 +58,21 @@ def restricted(role='ROLE_USER'):
     return decorator
 
 
+def _read_token(token):
+    """Decode the (user, role, encrypted passwd, expires) fields of a token"""
+    fields = token.split(':')
+    username = base64.b64decode(fields[0])
+    passwd_encrypted = fields[1]
+    token_role = base64.b64decode(fields[2])
+    #expires = time.localtime(int(fields[3])/1000)
+    expires = int(fields[3])/1000
+    return (username, token_role, passwd_encrypted, expires)
+
+
 def _is_token_signature_valid(token):
     fields = token.split(':')
     if len(fields) != 5:
-        _unauthorized()
+        return False
     subject = ':'.join(fields[:4])
     secret = KEYS
     subject = subject + ':' + secret
@@ -114,8 +124,72 @@ if IGNORE_AUTH:
     restricted = no_auth
 
 
-CONSUL_ENDPOINT = app.config.get('CONSUL_ENDPOINT')
-kv = kvstore.Client(CONSUL_ENDPOINT)
+def conditional(index):
+    """Answer conditional GETs with 304 Not Modified
+
+    index(**kwargs) receives the arguments of the view and returns the
+    Consul index of the registry data the response is built from, or None
+    when getting it would need a request of its own. The strong ETag of
+    the response combines that index with the path, the query string and
+    the negotiated content coding. When the index is known a request whose
+    If-None-Match matches gets a 304 before the view runs, otherwise the
+    view runs and the ETag comes from the index of the registry reads it
+    did (g.registry_index), so the 304 only saves sending the body. Goes
+    below restricted so the token is checked.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def decorated(*args, **kwargs):
+            consul_index = index(*args, **kwargs)
+            if consul_index is not None:
+                etag = _etag(consul_index)
+                if request.if_none_match.contains(etag):
+                    return _not_modified(etag)
+            response = make_response(f(*args, **kwargs))
+            if consul_index is None:
+                consul_index = g.get('registry_index')
+                if consul_index is None:
+                    return response
+                etag = _etag(consul_index)
+                if (response.status_code == 200 and
+                        request.if_none_match.contains(etag)):
+                    return _not_modified(etag)
+            if response.status_code == 200:
+                response.set_etag(etag)
+            return response
+        return decorated
+    return decorator
+
+
+def _etag(consul_index):
+    return hashlib.sha1('{}:{}:{}'.format(
+        consul_index, request.full_path, negotiate())).hexdigest()
+
+
+def _not_modified(etag):
+    response = make_response('', 304)
+    # A 304 has no body, so no representation headers either
+    del response.headers['Content-Type']
+    response.set_etag(etag)
+    return response
+
+
+def precondition(check):
+    """Run check(*args, **kwargs) before the view
+
+    check raises an exception handled by the api (eg. ValidationError) to
+    reject the request. Used above asynchronous to answer invalid requests
+    synchronously, before a job is created or anything is written, and
+    below restricted so that only authenticated requests are checked.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def decorated(*args, **kwargs):
+            check(*args, **kwargs)
+            return f(*args, **kwargs)
+        return decorated
+    return decorator
+
 
 def asynchronous(f):
     """Run the request asyncronously
@@ -132,28 +206,40 @@ def asynchronous(f):
         - Location header points to the newly created resource
 
     The client then needs to send a DELETE request to the task resource to
-    remove it from the system.
+    remove it from the system, otherwise it is deleted JOBS_TTL seconds
+    after it finished.
+
+    The request is stored as a durable job in the KV store (see jobs) and
+    run by the bounded workers.pool, when its queue is full the request
+    gets a 503 with a Retry-After header instead. Jobs left behind by a
+    process that stopped are resumed or failed by the other processes.
+
+    Goes below restricted: the job runs as the user authenticated when it
+    was submitted, its token is not stored.
     """
+    jobs.register(f)
+
     @functools.wraps(f)
     def decorator(*args, **kwargs):
-        id = uuid.uuid4().hex
-        kv.set('queue/{}/status'.format(id), 'pending')
-
-        @copy_current_request_context
-        def job():
-            response = make_response(f(*args, **kwargs))
-            status_code = response.status_code
-            if status_code == 201:
-                kv.set('queue/{}/status'.format(id), 'registered')
-            else:
-                kv.set('queue/{}/status'.format(id), 'error')
-            kv.set('queue/{}/status_code'.format(id), status_code)
-            kv.set('queue/{}/url'.format(id), response.headers['Location'])
-
-        job = threading.Thread(target=job)
-        job.start()
+        if workers.pool.full():
+            return _saturated()
+        id = jobs.create(f, kwargs)
+        try:
+            workers.pool.submit(functools.partial(jobs.run, id))
+        except workers.PoolSaturatedError:
+            jobs.delete(id)
+            return _saturated()
         location = url_for('api.get_async_job_status', id=id, _external=True)
         return jsonify({'url': location}), 202, {
             'Location': location}
 
     return decorator
+
+
+def _saturated():
+    workers.pool.reject()
+    response = jsonify({'status': 503, 'error': 'service unavailable',
+                        'message': 'too many pending requests, retry later'})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(workers.pool.retry_after())
+    return response
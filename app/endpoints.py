@@ -1,17 +1,66 @@
 from flask import abort, jsonify, request, g, url_for
 from . import api, app
 from . import utils
-import json
-import requests
+from . import snapshot
+from .catalog import products, product_index, product_dn, CATALOG_INDEX_KEY
+import itertools
 import registry
-import kvstore
-from .decorators import restricted, asynchronous
+from . import compression
+from . import consul
+from . import events
+from . import instantiation
+from . import jobs
+from . import mirror
+from . import outbound
+from . import workers
+from .decorators import restricted, asynchronous, conditional, precondition
+from .decorators import token_cache
+from .errors import ValidationError
 
 CONSUL_ENDPOINT = app.config.get('CONSUL_ENDPOINT')
 MESOS_FRAMEWORK_ENDPOINT = app.config.get('MESOS_FRAMEWORK_ENDPOINT')
+CLUSTERS_MAX_PAGE_SIZE = app.config.get('CLUSTERS_MAX_PAGE_SIZE', 1000)
+QUEUE_MAX_WAIT = app.config.get('QUEUE_MAX_WAIT', 300)
+QUEUE_STATUS_MAX_IDS = app.config.get('QUEUE_STATUS_MAX_IDS', 1000)
+
+# Fields that can be selected with ?fields= in the node and service listings
+NODE_FIELDS = ('dn', 'name') + registry.Node.__serializable__ + ('disks', 'networks')
+SERVICE_FIELDS = ('dn', 'name') + registry.Service.__serializable__
 
 registry.connect(CONSUL_ENDPOINT)
-kv = kvstore.Client(CONSUL_ENDPOINT)
+# registry.connect() builds its own client, share the pooled one instead
+registry._kv = consul.kv
+
+
+def _products_index(name=None):
+    return snapshot.index(CATALOG_INDEX_KEY)
+
+
+def _product_index(name, version):
+    return products.get(name, version).index
+
+
+def _clusters_index(username=None, product=None, version=None, id=None):
+    prefix = snapshot.cluster_prefix(username, product, version)
+    if id is not None:
+        prefix += id + '/'
+    return snapshot.index(prefix)
+
+
+def _job_index(id):
+    """Index of a job, after waiting for it to finish if ?wait= is given
+
+    Waiting here instead of in the view means that a long poll with
+    If-None-Match also waits before answering 304.
+    """
+    wait = request.args.get('wait')
+    if wait is None:
+        return snapshot.index(jobs.job_key(id))
+    try:
+        timeout = consul.duration(wait)
+    except ValueError:
+        raise ValidationError('invalid wait time: {}'.format(wait))
+    return jobs.wait(id, min(timeout, QUEUE_MAX_WAIT))
 
 
 @api.route('/products', methods=['POST'])
@@ -27,6 +76,8 @@ def register_product():
             description = data['description']
             logo_url = data['logo_url']
             registry.register(name, version, description, logo_url=logo_url)
+            product_index.add(name, version, description=description,
+                              logo_url=logo_url)
             location = url_for('api.get_product', name=name, version=version,
                                _external=True)
             return '', 201, {'Location': location}
@@ -35,32 +86,57 @@ def register_product():
 
 @api.route('/products', methods=['GET'])
 @restricted(role='ROLE_USER')
+@conditional(_products_index)
 def get_products():
     """Get the current list of registered products"""
-    products = registry.query_products() or list()
-    return jsonify({'products': list(set([p.name for p in products]))})
+    return jsonify({'products': sorted(product_index.get())})
 
 
 @api.route('/products/<name>', methods=['GET'])
+@conditional(_products_index)
 def get_product_versions(name):
     """Get the available versions of a produt"""
-    products = registry.query_products(product=name)
-    return jsonify({'versions': [p.version for p in products]})
+    return jsonify({'versions': product_index.versions(name)})
+
+
+@api.route('/products/<name>/<version>', methods=['DELETE'])
+@restricted(role='ROLE_USER')
+def deregister_product(name, version):
+    """Deregister a specific version of a product"""
+    products.get(name, version)
+    # registry.deregister() deletes the dn as a prefix, which would take
+    # other versions starting with this one (eg. 3.0.8 for 3.0) with it
+    consul.kv.delete(product_dn(name, version) + '/', recursive=True)
+    product_index.remove(name, version)
+    products.invalidate(name, version)
+    instantiation.templates.invalidate(name, version)
+    return '', 204
+
+
+@api.route('/catalog/rebuild', methods=['POST'])
+@restricted(role='ROLE_USER')
+def rebuild_product_index():
+    """Rebuild the product index from the registry"""
+    catalog = product_index.rebuild()
+    return jsonify({'products': len(catalog),
+                    'versions': sum(len(v) for v in catalog.values())})
 
 
 @api.route('/products/<name>/<version>', methods=['GET'])
 @restricted(role='ROLE_USER')
+@conditional(_product_index)
 def get_product(name, version):
     """Get info about a specific version of a product"""
-    product = registry.get_product(name, version)
+    product = products.get(name, version)
     return jsonify(product.to_dict())
 
 
 @api.route('/products/<name>/<version>/template', methods=['GET'])
 @restricted(role='ROLE_USER')
+@conditional(_product_index)
 def get_product_template(name, version):
     """Get the template used to generate the resources needed by a product"""
-    product = registry.get_product(name, version)
+    product = products.get(name, version)
     template = product.template
     return jsonify(template)
 
@@ -77,16 +153,18 @@ def set_product_template(name, version):
     product = registry.get_product(name, version)
     product.template = data
     product.templatetype = templatetype
+    products.invalidate(name, version)
+    instantiation.templates.invalidate(name, version)
     return '', 204
 
 
 @api.route('/products/<name>/<version>/options', methods=['GET'])
 @restricted(role='ROLE_USER')
+@conditional(_product_index)
 def get_product_options(name, version):
     """Get the options needed by the product template"""
-    product = registry.get_product(name, version)
-    options = json.loads(product.options)
-    return jsonify(options)
+    product = products.get(name, version)
+    return jsonify(product.schema.document)
 
 
 @api.route('/products/<name>/<version>/options', methods=['PUT'])
@@ -96,14 +174,16 @@ def set_product_options(name, version):
     data = request.get_data().decode('utf-8')
     product = registry.get_product(name, version)
     product.options = data
+    products.invalidate(name, version)
     return '', 204
 
 
 @api.route('/products/<name>/<version>/orchestrator', methods=['GET'])
 @restricted(role='ROLE_USER')
+@conditional(_product_index)
 def get_product_orchestrator(name, version):
     """Get the orchestrator needed to start the product once instantiated"""
-    product = registry.get_product(name, version)
+    product = products.get(name, version)
     orchestrator = product.orchestrator
     return jsonify(orchestrator)
 
@@ -115,14 +195,16 @@ def set_product_orchestrator(name, version):
     data = request.get_data().decode('utf-8')
     product = registry.get_product(name, version)
     product.orchestrator = data
+    products.invalidate(name, version)
     return '', 204
 
 
 @api.route('/products/<name>/<version>/logo_url', methods=['GET'])
 @restricted(role='ROLE_USER')
+@conditional(_product_index)
 def get_product_logo_url(name, version):
     """Get the product logo url"""
-    product = registry.get_product(name, version)
+    product = products.get(name, version)
     logo_url = product.logo_url
     return jsonify(logo_url)
 
@@ -137,13 +219,37 @@ def set_product_logo_url(name, version):
             logo_url = data['logo_url']
             product = registry.get_product(name, version)
             product.logo_url = logo_url
+            products.invalidate(name, version)
+            product_index.add(name, version, logo_url=logo_url)
             return '', 204
     abort(400)
 
 
+@api.route('/products/<name>/<version>/render', methods=['POST'])
+@restricted(role='ROLE_USER')
+def render_product(name, version):
+    """Render the template with the given options without launching it
+
+    The response includes the render time and the number of nodes, keys
+    and transactions needed to register the cluster. The rendered topology
+    is included with ?topology=true.
+    """
+    options = request.get_json(silent=True)
+    if not isinstance(options, dict):
+        raise ValidationError('the options must be a JSON object')
+    topology = request.args.get('topology') in ('1', 'true')
+    return jsonify(instantiation.dry_run(g.user, name, version, options,
+                                         topology=topology))
+
+
+def _check_launch_options(product, version):
+    products.get(product, version).schema.validate(request.get_json(silent=True))
+
+
 @api.route('/products/<product>/<version>', methods=['POST'])
-@asynchronous
 @restricted(role='ROLE_USER')
+@precondition(_check_launch_options)
+@asynchronous
 def launch_cluster(product, version):
     """Launch a new cluster instance"""
     app.logger.info('Request to launch a new cluster instance from user {}'
@@ -152,16 +258,15 @@ def launch_cluster(product, version):
     options = request.get_json()
 
     app.logger.info('Registering the cluster instance in the registry')
-    cluster = registry.instantiate(username, product, version, options)
+    cluster = instantiation.instantiate(username, product, version, options)
     clusterdn = cluster.dn
     # cluster.name has the ID number of the cluster: eg. 6
     id = cluster.name
-    cluster.status = 'registered'
 
 
     app.logger.info('Submitting cluster instance to Mesos')
     data = {'clusterdn': clusterdn}
-    response = requests.post(MESOS_FRAMEWORK_ENDPOINT, json=data)
+    response = outbound.post(MESOS_FRAMEWORK_ENDPOINT, json=data)
     if response.status_code != 200:
         app.logger.error('Mesos framework returned {}'.format(response.status_code))
         app.logger.error('{}'.format(response.json()))
@@ -177,77 +282,139 @@ def launch_cluster(product, version):
 
 @api.route('/clusters', methods=['GET'])
 @restricted(role='ROLE_USER')
+@conditional(_clusters_index)
 def get_all_clusters():
     app.logger.info('Request for all clusters')
-    clusters = registry.query_clusters()  or list()
-    return jsonify({
-        'clusters': [utils.print_instance(instance, (None, None, None))
-                     for instance in clusters]})
+    return _clusters_page()
 
 
 @api.route('/clusters/<username>', methods=['GET'])
 @restricted(role='ROLE_USER')
+@conditional(_clusters_index)
 def get_user_clusters(username):
     app.logger.info('Request for clusters of user {} '.format(username))
+    return _clusters_page(username)
 
-    clusters = registry.query_clusters(user=username) or list()
-    return jsonify({
-        'clusters': [utils.print_instance(instance, (username, None, None))
-                      for instance in clusters]})
+
+@api.route('/clusters/<username>/events', methods=['GET'])
+@restricted(role='ROLE_USER')
+def get_user_events(username):
+    """Stream the cluster status changes and finished jobs of a user
+
+    Server-Sent Events: a status event is sent when the status of a
+    cluster of the user changes and a job event when one of its async
+    requests finishes.
+    """
+    app.logger.info('Event stream for user {}'.format(username))
+    return events.stream(username)
 
 
 @api.route('/clusters/<username>/<product>', methods=['GET'])
 @restricted(role='ROLE_USER')
+@conditional(_clusters_index)
 def get_user_product_clusters(username, product):
     app.logger.info('Request for clusters of user {} and service {}'.format(username, product))
-    clusters = registry.query_clusters(username, product) or list()
-    return jsonify({
-        'clusters': [utils.print_instance(instance, (username, product, None))
-                      for instance in clusters]})
+    return _clusters_page(username, product)
 
 
 @api.route('/clusters/<username>/<product>/<version>', methods=['GET'])
 @restricted(role='ROLE_USER')
+@conditional(_clusters_index)
 def get_user_product_version_clusters(username, product, version):
     app.logger.info('Request for clusters of user {} and service {} with version {}'
                     .format(username, product, version))
-    clusters = registry.query_clusters(username, product, version)  or list()
-    return jsonify({
-        'clusters': [utils.print_instance(instance, (username, product, version))
-                      for instance in clusters]})
+    return _clusters_page(username, product, version)
+
+
+def _clusters_page(username=None, product=None, version=None):
+    """List the clusters below the given prefix
+
+    Supports the query parameters:
+      - status, product: only clusters with the given status or product
+      - since: only clusters modified after the given Consul index
+      - limit, cursor: return at most limit clusters, when there are more
+        the response includes the url of the next page
+    Only the clusters after the cursor are decoded and only the requested
+    page is serialized. The response is streamed while clusters are decoded.
+    """
+    limit = utils.int_arg('limit')
+    if limit is not None and not 0 < limit <= CLUSTERS_MAX_PAGE_SIZE:
+        raise ValidationError('limit must be between 1 and {}'
+                              .format(CLUSTERS_MAX_PAGE_SIZE))
+    cursor = request.args.get('cursor')
+    after = utils.decode_cursor(cursor) if cursor else None
+
+    clusters = snapshot.iter_clusters(username, product, version, after=after)
+    clusters = utils.filter_clusters(
+        clusters,
+        status=request.args.get('status'),
+        product=request.args.get('product'),
+        since=utils.int_arg('since'))
+    extra = {}
+    if limit is None:
+        page = clusters
+    else:
+        page = list(itertools.islice(clusters, limit + 1))
+        if len(page) > limit:
+            page = page[:limit]
+            args = request.args.to_dict()
+            args.update(request.view_args)
+            args['cursor'] = utils.encode_cursor(page[-1].dn)
+            extra['next'] = url_for(request.endpoint, _external=True, **args)
+
+    return utils.stream_list(
+        'clusters',
+        (utils.print_instance(instance, (username, product, version))
+         for instance in page),
+        extra)
 
 
 @api.route('/clusters/<username>/<product>/<version>/<id>', methods=['GET'])
 @restricted(role='ROLE_USER')
+@conditional(_clusters_index)
 def get_cluster(username, product, version, id):
-    cluster = registry.get_cluster(username, product, version, id)
-    return jsonify(utils.print_full_instance(cluster))
+    fields = utils.requested_fields([f for f, _ in utils.CLUSTER_FIELDS])
+    cluster = snapshot.load_cluster(username, product, version, id,
+                                    attributes=utils.cluster_attributes(fields))
+    return jsonify(utils.print_full_instance(cluster, fields))
 
 
 @api.route('/clusters/<username>/<product>/<version>/<id>/nodes', methods=['GET'])
 @restricted(role='ROLE_USER')
+@conditional(_clusters_index)
 def get_cluster_nodes(username, product, version, id):
     app.logger.info('Request for instance nodes of user {} and service {} with '
                     'version {}'.format(username, product, version))
-    cluster = registry.get_cluster(username, product, version, id)
-
-    data = list()
-    nodes = cluster.nodes
-    for node in nodes:
-        d = node.to_dict()
-        d["disks"] = [{"name": disk.name, "host": node.host} for disk in node.disks]
-        d["networks"] = [{"name": network.name, "address": network.address} for network in node.networks]
-        data.append(d)
-
-    return jsonify({'nodes': data})
-    #return jsonify({'nodes': [node.to_dict() for node in cluster.nodes]})
+    fields = utils.requested_fields(NODE_FIELDS)
+    containers = ['nodes'] + ['nodes/' + c for c in ('disks', 'networks')
+                              if fields is None or c in fields]
+    cluster = snapshot.load_cluster_tree(username, product, version, id,
+                                         containers=containers)
+
+    def nodes():
+        for node in cluster.subrecords('nodes'):
+            d = utils.project(snapshot.to_dict(node, registry.Node), fields)
+            if fields is None or 'disks' in fields:
+                d["disks"] = [{"name": disk.name, "host": node.get('host')}
+                              for disk in node.subrecords('disks')]
+            if fields is None or 'networks' in fields:
+                d["networks"] = [{"name": network.name, "address": network.get('address')}
+                                 for network in node.subrecords('networks')]
+            yield d
+
+    return utils.stream_list('nodes', nodes())
 
 
 @api.route('/clusters/<username>/<product>/<version>/<id>/services', methods=['GET'])
 @restricted(role='ROLE_USER')
+@conditional(_clusters_index)
 def get_cluster_services(username, product, version, id):
-    cluster = registry.get_cluster(username, product, version, id)
-    return jsonify({'services': [s.to_dict() for s in cluster.services]})
+    fields = utils.requested_fields(SERVICE_FIELDS)
+    cluster = snapshot.load_cluster_tree(username, product, version, id,
+                                         containers=['services'])
+    return jsonify({'services': [
+        utils.project(snapshot.to_dict(s, registry.Service), fields)
+        for s in cluster.subrecords('services')]})
 
 
 @api.route('/clusters/<username>/<product>/<version>/<id>', methods=['DELETE'])
@@ -255,7 +422,7 @@ def get_cluster_services(username, product, version, id):
 def destroy_cluster(username, product, version, id):
     # Remove from the mesos system
     cluster = registry.get_cluster(username, product, version, id)
-    response = requests.delete('{}/{}'.format(MESOS_FRAMEWORK_ENDPOINT, registry.id_from(cluster.dn)))
+    response = outbound.delete('{}/{}'.format(MESOS_FRAMEWORK_ENDPOINT, registry.id_from(cluster.dn)))
     if response.status_code != 204:
         app.logger.error('Mesos framework error. Response: {}'.format(response))
         abort(500)
@@ -265,14 +432,93 @@ def destroy_cluster(username, product, version, id):
     return jsonify({"message": "success"}), 200
 
 
+@api.route('/queue', methods=['GET'])
+@restricted(role='ROLE_USER')
+def get_queue_info():
+    """Get the usage of the pool running the async requests"""
+    return jsonify(workers.pool.info())
+
+
+@api.route('/metrics', methods=['GET'])
+@restricted(role='ROLE_USER')
+def get_metrics():
+    """Get the usage of the pools, caches and mirrors of this process"""
+    return jsonify({
+        'workers': workers.pool.info(),
+        'outbound': outbound.pool.info(),
+        'templates': instantiation.templates.info(),
+        'dry_runs': instantiation.dry_runs.info(),
+        'products': products.info(),
+        'tokens': token_cache.info(),
+        'compressed_bodies': compression.compressed_bodies.info(),
+        'mirrors': {'instances': mirror.instances.info(),
+                    'queue': events.queue.info()},
+        'events': events.bus.info()})
+
+
 @api.route('/queue/<id>', methods=['GET'])
 @restricted(role='ROLE_USER')
+@conditional(_job_index)
 def get_async_job_status(id):
-    """Get the status of an async request"""
-    status = kv.get('queue/{}/status'.format(id))
-    if status != 'pending':
-        url = kv.get('queue/{}/url'.format(id))
-        status = kv.get('queue/{}/status'.format(id))
+    """Get the status of an async request
+
+    With ?wait=<duration> (eg. 30s) the request blocks until the job
+    finishes or the wait time expires.
+    """
+    job = jobs.get(id)
+    status = job.get('status')
+    if status == 'pending':
+        return jsonify({'status': 'pending'}), 200
+    url = job.get('url')
+    if url:
         return (jsonify({'status': status, 'url': url}), 303,
                 {'Location': url})
-    return jsonify({'status': 'pending'}), 200
+    return jsonify({'status': status,
+                    'status_code': int(job.get('status_code') or 500)}), 200
+
+
+@api.route('/queue/status', methods=['POST'])
+@restricted(role='ROLE_USER')
+def get_async_jobs_status():
+    """Get the status of several async requests at once
+
+    Takes a list of job ids, or {"ids": [...]}, and answers all of them
+    from the queue mirror or a single read of the queue.
+    """
+    data = request.get_json(silent=True)
+    ids = data.get('ids') if isinstance(data, dict) else data
+    if (not isinstance(ids, list) or
+            not all(isinstance(id, basestring) for id in ids)):
+        raise ValidationError('a list of job ids is required')
+    if len(ids) > QUEUE_STATUS_MAX_IDS:
+        raise ValidationError('at most {} job ids are allowed'
+                              .format(QUEUE_STATUS_MAX_IDS))
+    events.queue.start()
+    entries = None
+    if events.queue.fresh():
+        g.registry_staleness = events.queue.staleness()
+        entries = events.queue.entries(jobs.QUEUE_PREFIX + '/')
+    return jsonify({'jobs': jobs.summaries(ids, entries)})
+
+
+@api.route('/queue/<id>', methods=['DELETE'])
+@restricted(role='ROLE_USER')
+def delete_async_job(id):
+    """Remove a finished async request"""
+    job = jobs.get(id)
+    if job.get('status') == 'pending':
+        response = jsonify({'status': 409, 'error': 'conflict',
+                            'message': 'the request has not finished yet'})
+        response.status_code = 409
+        return response
+    jobs.delete(id)
+    return '', 204
+
+
+@api.after_request
+def add_registry_staleness(response):
+    """Report the staleness of responses served from the instances mirror"""
+    staleness = g.get('registry_staleness')
+    if staleness is not None:
+        response.headers['X-Registry-Staleness'] = '{:.3f}'.format(staleness)
+    return response
@@ -0,0 +1,142 @@
+import json
+import Queue
+import threading
+
+from flask import Response
+
+from . import app
+from . import jobs
+from . import mirror
+from . import snapshot
+
+EVENTS_QUEUE_SIZE = app.config.get('EVENTS_QUEUE_SIZE', 100)
+# Seconds between the comments sent to keep idle streams open
+EVENTS_HEARTBEAT = app.config.get('EVENTS_HEARTBEAT', 15)
+
+
+class Subscriber(object):
+    """Events pending to be sent to one client
+
+    A client that does not keep up loses its stream when its queue fills
+    up, it can then reconnect and reload the current state.
+    """
+
+    def __init__(self, user, maxsize):
+        self.user = user
+        self.queue = Queue.Queue(maxsize=maxsize)
+        self.overflowed = False
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except Queue.Full:
+            self.overflowed = True
+
+
+class EventBus(object):
+    """Delivers the events of each user to the streams open for that user"""
+
+    def __init__(self, queue_size=100):
+        self.queue_size = queue_size
+        self.published = 0
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, user):
+        subscriber = Subscriber(user, self.queue_size)
+        with self._lock:
+            self._subscribers.setdefault(user, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(subscriber.user, set())
+            subscribers.discard(subscriber)
+            if not subscribers:
+                self._subscribers.pop(subscriber.user, None)
+
+    def publish(self, user, event, data, id=None):
+        with self._lock:
+            subscribers = list(self._subscribers.get(user, ()))
+        for subscriber in subscribers:
+            subscriber.put((event, data, id))
+        self.published += 1
+
+    def info(self):
+        with self._lock:
+            streams = sum(len(s) for s in self._subscribers.values())
+        return {'users': len(self._subscribers), 'streams': streams,
+                'published': self.published}
+
+
+bus = EventBus(queue_size=EVENTS_QUEUE_SIZE)
+# Job records, watched from the first event stream opened
+queue = mirror.Mirror(jobs.QUEUE_PREFIX + '/',
+                      wait=app.config.get('MIRROR_WAIT', '30s'),
+                      max_staleness=app.config.get('MIRROR_MAX_STALENESS', 45))
+
+
+def stream(user):
+    """Server-Sent Events response with the events of the given user
+
+    status events carry the dn and the new status of a cluster, job events
+    the result of an async request. Both come from the shared mirrors of
+    the instances and queue trees, so open streams add no Consul requests.
+    Without MIRROR_INSTANCES the instances are not watched and there are
+    no status events.
+    """
+    if app.config.get('MIRROR_INSTANCES'):
+        mirror.instances.start()
+    queue.start()
+    subscriber = bus.subscribe(user)
+
+    def generate():
+        try:
+            yield 'retry: 5000\n\n'
+            while not subscriber.overflowed:
+                try:
+                    (event, data, id) = subscriber.queue.get(
+                        timeout=EVENTS_HEARTBEAT)
+                except Queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                message = 'event: {}\ndata: {}\n\n'.format(event, json.dumps(data))
+                if id is not None:
+                    message = 'id: {}\n'.format(id) + message
+                yield message
+        finally:
+            bus.unsubscribe(subscriber)
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
+
+
+def _cluster_changes(changed, removed):
+    """Publish the status changes seen by the instances mirror"""
+    statuses = [(e['Key'], e['Value'], e['ModifyIndex']) for e in changed]
+    statuses.extend((key, None, None) for key in removed)
+    for (key, status, index) in statuses:
+        fields = key.split('/')
+        if len(fields) != snapshot.CLUSTER_DN_FIELDS + 1 or fields[-1] != 'status':
+            continue
+        dn = key.rsplit('/', 1)[0]
+        (user, _, _, _) = snapshot.cluster_fields(dn)
+        bus.publish(user, 'status', {'dn': dn, 'status': status}, index)
+
+
+def _job_changes(changed, removed):
+    """Publish the async requests that finished"""
+    for e in changed:
+        fields = e['Key'].split('/')
+        if len(fields) != 2:
+            continue
+        job = json.loads(e['Value'])
+        if job.get('status') == 'pending' or not job.get('user'):
+            continue
+        data = jobs.summary(job)
+        data['id'] = fields[1]
+        bus.publish(job['user'], 'job', data, e['ModifyIndex'])
+
+
+mirror.instances.subscribe(_cluster_changes)
+queue.subscribe(_job_changes)
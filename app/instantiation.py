@@ -0,0 +1,200 @@
+import hashlib
+import json
+import math
+import time
+
+import jinja2
+import registry
+import yaml
+
+from . import app
+from . import consul
+from .cache import LRUCache
+from .catalog import products
+
+# Bounds of a render: loop iterations of the template (eg. nodes times
+# disks) and keys of the rendered cluster, the options of bigger clusters
+# are rejected as invalid
+RENDER_MAX_ITERATIONS = app.config.get('RENDER_MAX_ITERATIONS', 50000)
+CLUSTER_MAX_KEYS = app.config.get('CLUSTER_MAX_KEYS', 50000)
+
+
+class TemplateCache(object):
+    """Compiled jinja2 templates of the products
+
+    Entries are kept by product and version together with the sha1 of the
+    template source they were compiled from, so a template is parsed and
+    compiled once per revision no matter how many clusters are launched
+    from it. A template modified through another worker is noticed because
+    its hash changes, set_product_template() invalidates the entry.
+    """
+
+    def __init__(self, maxsize=128):
+        self.environment = jinja2.Environment()
+        self.compilations = 0
+        self._templates = LRUCache(maxsize=maxsize)
+
+    def get(self, product, version, source):
+        """Get the compiled template for the given template source"""
+        data = source if isinstance(source, bytes) else source.encode('utf-8')
+        digest = hashlib.sha1(data).hexdigest()
+        entry = self._templates.get((product, version))
+        if entry is not None and entry[0] == digest:
+            return entry[1]
+        template = self.environment.from_string(source)
+        self.compilations += 1
+        self._templates.set((product, version), (digest, template))
+        return template
+
+    def invalidate(self, product, version):
+        self._templates.invalidate((product, version))
+
+    def info(self):
+        info = self._templates.info()
+        info['compilations'] = self.compilations
+        return info
+
+
+templates = TemplateCache(maxsize=app.config.get('TEMPLATE_CACHE_SIZE', 128))
+
+
+def instantiate(user, product, version, options):
+    """Register a new cluster instance of the given product version
+
+    Same as registry.instantiate() but the rendered cluster is written with
+    the Consul transaction API, TXN_MAX_OPERATIONS keys per request instead
+    of one request per key. The cluster status is set to registered in the
+    last transaction, so it is only registered once all its keys exist.
+    Clusters too big for one transaction are not written atomically: if a
+    transaction fails the keys already written are deleted again.
+    """
+    product_doc = products.get(product, version)
+    mergedopts = merged_options(product_doc, options)
+
+    prefix = '{}/{}/{}/{}'.format(registry.PREFIX, user, product, version)
+    id = registry.generate_id(prefix)
+    dn = '{}/{}'.format(prefix, id)
+
+    data = render(product_doc, mergedopts, user, product, version, dn)
+    kvinfo = cluster_keys(data, dn)
+    try:
+        consul.save(kvinfo, last=['{}/status'.format(dn)])
+    except Exception:
+        _rollback(dn)
+        raise
+    return registry.get_cluster(dn=dn)
+
+
+def _rollback(dn):
+    """Delete the keys of a cluster whose registration failed"""
+    try:
+        consul.kv.delete(dn + '/', recursive=True)
+    except Exception as e:
+        app.logger.error('Unable to remove the partially registered cluster '
+                         '{}: {}'.format(dn, e))
+
+
+# Cluster ID used by dry runs, registered clusters start at 1
+DRY_RUN_ID = 0
+dry_runs = LRUCache(maxsize=app.config.get('DRY_RUN_CACHE_SIZE', 64))
+
+
+def dry_run(user, product, version, options, topology=False):
+    """Render a cluster of the given product version without registering it
+
+    Returns the merged options, the time spent rendering, the number of
+    nodes and services and the number of keys and transactions
+    instantiate() would write, plus the rendered topology when asked for.
+    Reports are memoized without the topology by the hash of the merged
+    options and the Consul index of the product, so they are computed
+    again when the template changes. Asking for the topology always
+    renders the template.
+    """
+    product_doc = products.get(product, version)
+    mergedopts = merged_options(product_doc, options)
+    digest = hashlib.sha1(json.dumps(mergedopts, sort_keys=True)).hexdigest()
+    key = (user, product, version, product_doc.index, digest)
+    report = dry_runs.get(key)
+    if report is not None and not topology:
+        return dict(report, options=mergedopts, cached=True)
+
+    dn = '{}/{}/{}/{}/{}'.format(registry.PREFIX, user, product, version,
+                                 DRY_RUN_ID)
+    start = time.time()
+    data = render(product_doc, mergedopts, user, product, version, dn)
+    render_time = time.time() - start
+    kvinfo = cluster_keys(data, dn)
+    report = {
+        'dn': dn,
+        'render_time': render_time,
+        'nodes': len(data.get('nodes') or {}) if registry.isdict(data) else 0,
+        'services': len(data.get('services') or {}) if registry.isdict(data) else 0,
+        'keys': len(kvinfo),
+        'transactions': int(math.ceil(float(len(kvinfo)) / consul.TXN_MAX_OPERATIONS)),
+    }
+    dry_runs.set(key, report)
+    report = dict(report, options=mergedopts, cached=False)
+    if topology:
+        report['topology'] = data
+    return report
+
+
+def cluster_keys(data, dn):
+    """Keys of the rendered cluster as written by instantiate()"""
+    kvinfo = {}
+    registry._populate(kvinfo, using=data, prefix=dn)
+    kvinfo['{}/status'.format(dn)] = 'registered'
+    if len(kvinfo) > CLUSTER_MAX_KEYS:
+        raise registry.InvalidOptionsError(
+            'the cluster would have {} keys, at most {} are allowed'
+            .format(len(kvinfo), CLUSTER_MAX_KEYS))
+    return kvinfo
+
+
+def merged_options(product_doc, options):
+    """Validate the options of a launch and merge them with the defaults"""
+    return product_doc.schema.merge(options)
+
+
+def render(product_doc, opts, user, product, version, dn):
+    """Render the product template into the cluster topology
+
+    The loops of the template get at most RENDER_MAX_ITERATIONS iterations
+    in total, see BoundedRange.
+    """
+    t = templates.get(product, version, product_doc.template)
+    rendered = t.render(opts=opts, user=user, product=product,
+                        version=version, clusterdn=dn,
+                        clusterid=registry.id_from(dn),
+                        range=BoundedRange(RENDER_MAX_ITERATIONS))
+    if product_doc.templatetype == 'json+jinja2':
+        return json.loads(rendered)
+    elif product_doc.templatetype == 'yaml+jinja2':
+        return yaml.load(rendered)
+    raise registry.UnsupportedTemplateFormatError(
+        'type: {}'.format(product_doc.templatetype))
+
+
+class BoundedRange(object):
+    """range() of a template render with a budget of iterations
+
+    Templates loop over range() of their options (eg. one node per
+    range(opts['size'])), so the budget is checked before each loop starts
+    and options that would keep a worker rendering for long are rejected
+    instead.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+
+    def __call__(self, *args):
+        try:
+            values = xrange(*args)
+            self.budget -= len(values)
+        except OverflowError:
+            self.budget = -1
+        if self.budget < 0:
+            raise registry.InvalidOptionsError(
+                'the options render more than {} template iterations'
+                .format(RENDER_MAX_ITERATIONS))
+        return values
@@ -0,0 +1,418 @@
+import base64
+import functools
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+import kvstore
+from flask import g, request, make_response
+
+from . import app
+from . import consul
+from . import snapshot
+from . import workers
+
+QUEUE_PREFIX = 'queue'
+# Payloads of the jobs, apart from queue/ so reading the queue skips them
+PAYLOADS_PREFIX = 'queue-payloads'
+# Held by the one process that recovers and sweeps the jobs of all of them
+MAINTENANCE_LOCK = 'queue-maintenance'
+SESSION_TTL = app.config.get('JOBS_SESSION_TTL', '30s')
+RECOVERY_INTERVAL = app.config.get('JOBS_RECOVERY_INTERVAL', 60)
+# Seconds finished jobs are kept before the sweeper deletes them
+JOBS_TTL = app.config.get('JOBS_TTL', 86400)
+# Request headers stored with a job, needed to run its request again. The
+# credentials (X-Auth-Token) are not stored, see create()
+JOB_HEADERS = ('Content-Type',)
+
+# Views run as jobs by name, registered by the asynchronous decorator
+handlers = {}
+
+
+def job_key(id):
+    """Key of the JSON document of a job
+
+    The document has the status and, once the job finished, the
+    status_code, url, user and finished time. The payload is in
+    payload_key(id) and the lock of the job is queue/<id>/lock. Jobs
+    stored before the documents were introduced have one key per field
+    below queue/<id>/ and no payload, they are still understood.
+    """
+    return '{}/{}'.format(QUEUE_PREFIX, id)
+
+
+def payload_key(id):
+    return '{}/{}'.format(PAYLOADS_PREFIX, id)
+
+
+def lock_key(id):
+    return '{}/{}/lock'.format(QUEUE_PREFIX, id)
+
+
+def register(handler):
+    """Allow the given view to be run as a job"""
+    handlers[handler.__name__] = handler
+
+
+def create(handler, view_args):
+    """Store the current request as a new pending job and return its id
+
+    The job payload keeps what is needed to run the request again from any
+    API process: the view, its arguments, the path, the body and the user
+    and role authenticated by restricted(). The token itself is never
+    stored, anyone able to read the KV store could use it, so the request
+    must have been authenticated already. The job and its payload are
+    written in one transaction.
+    """
+    id = uuid.uuid4().hex
+    payload = {'handler': handler.__name__, 'view_args': view_args,
+               'method': request.method, 'path': request.path,
+               'query_string': request.query_string,
+               'base_url': request.url_root,
+               'headers': {h: request.headers[h] for h in JOB_HEADERS
+                           if h in request.headers},
+               'data': request.get_data(),
+               'user': g.user, 'role': g.role}
+    job = {'status': 'pending', 'created': time.time()}
+    consul.txn([
+        {'Verb': 'cas', 'Key': job_key(id), 'Index': 0,
+         'Value': base64.b64encode(json.dumps(job))},
+        {'Verb': 'cas', 'Key': payload_key(id), 'Index': 0,
+         'Value': base64.b64encode(json.dumps(payload))}])
+    return id
+
+
+def read_payload(id):
+    """Payload of a job, None if it has none"""
+    entries, _ = consul.read(payload_key(id))
+    return json.loads(entries[0]['Value']) if entries else None
+
+
+def scan(entries=None):
+    """Jobs by id from the entries below queue/
+
+    Each job is {'job': fields, 'index': ModifyIndex of the document (0
+    for old records), 'session': session holding the lock or None}. The
+    entries are read with one recursive read when not given.
+    """
+    if entries is None:
+        entries, _ = consul.read(QUEUE_PREFIX + '/', recurse=True)
+    jobs = {}
+    for e in entries:
+        fields = e['Key'].split('/')
+        if len(fields) < 2 or len(fields) > 3:
+            continue
+        record = jobs.setdefault(fields[1], {'job': None, 'index': 0,
+                                             'session': None, 'fields': {}})
+        if len(fields) == 2:
+            record['job'] = json.loads(e['Value'])
+            record['index'] = e['ModifyIndex']
+        elif fields[2] == 'lock':
+            record['session'] = e.get('Session')
+        else:
+            record['fields'][fields[2]] = e['Value']
+    for record in jobs.values():
+        fields = record.pop('fields')
+        if record['job'] is None and 'status' in fields:
+            record['job'] = fields
+    return {id: record for id, record in jobs.items()
+            if record['job'] is not None or record['session'] is None}
+
+
+def read(id):
+    """Get (fields, document index) of a job with a single read"""
+    entries, consul_index = consul.read(job_key(id), recurse=True)
+    snapshot.record_index(consul_index)
+    record = scan(entries).get(id)
+    if record is None or record['job'] is None:
+        raise kvstore.KeyDoesNotExist('Job {} does not exist'.format(id))
+    return record['job'], record['index']
+
+
+def get(id):
+    """Get the fields of a job as a dict"""
+    return read(id)[0]
+
+
+def update(id, change):
+    """Apply change(fields) to a job and store it with check-and-set
+
+    Retried until no other process modified the job in between. Old
+    records get a document the first time they are updated.
+    """
+    while True:
+        (job, index) = read(id)
+        change(job)
+        if consul.cas(job_key(id), json.dumps(job), index):
+            return job
+
+
+def wait(id, timeout):
+    """Wait up to timeout seconds for a pending job to finish
+
+    Uses Consul blocking queries on the job, so it returns as soon as the
+    job finishes no matter which process runs it. Returns the Consul index
+    of the job.
+    """
+    deadline = time.time() + timeout
+    index = None
+    while True:
+        remaining = deadline - time.time()
+        entries, index = consul.read(
+            job_key(id), recurse=True, index=index,
+            wait='{}ms'.format(max(int(remaining * 1000), 1)))
+        record = scan(entries).get(id)
+        if record is None or record['job'] is None:
+            raise kvstore.KeyDoesNotExist('Job {} does not exist'.format(id))
+        if record['job'].get('status') != 'pending' or deadline <= time.time():
+            return index
+
+
+def delete(id):
+    consul.delete_trees([job_key(id), payload_key(id)])
+
+
+def run(id):
+    """Run a pending job if this process manages to claim it
+
+    The job is claimed by locking queue/<id>/lock with the Consul session
+    of the process, the lock is released when the session is invalidated
+    so the job of a process that died can be claimed by another one. A
+    job that was already started by a process that died is failed instead
+    of run again, its request may have been partially applied.
+    """
+    session = sessions.get()
+    lock = lock_key(id)
+    if not consul.acquire(lock, _owner(), session):
+        return
+    try:
+        try:
+            job = get(id)
+        except kvstore.KeyDoesNotExist:
+            # Deleted before it was claimed, drop the lock just created
+            delete(id)
+            return
+        if job.get('status') != 'pending':
+            return
+        payload = read_payload(id)
+        # Failed jobs are published to their user too, see events
+        user = (payload or {}).get('user')
+        if job.get('attempts') or payload is None:
+            app.logger.warn('Failing interrupted job {}'.format(id))
+            finish(id, 'error', 500, user=user)
+            return
+        update(id, lambda job: job.update(attempts=1))
+        try:
+            (response, user) = execute(payload)
+        except Exception as e:
+            app.logger.exception('Job {} failed: {}'.format(id, e))
+            finish(id, 'error', 500, user=user)
+            return
+        status = 'registered' if response.status_code == 201 else 'error'
+        finish(id, status, response.status_code,
+               response.headers.get('Location', ''), user)
+    finally:
+        consul.release(lock, session)
+
+
+def execute(payload):
+    """Run the request stored in a job payload
+
+    The request runs as the user and role stored in the payload, which
+    were authenticated when the job was created. Returns the response and
+    the user of the request.
+    """
+    handler = handlers[payload['handler']]
+    with app.test_request_context(
+            payload['path'], base_url=payload['base_url'],
+            method=payload['method'], query_string=payload['query_string'],
+            headers=payload['headers'], data=payload['data']):
+        g.user = payload['user']
+        g.role = payload['role']
+        try:
+            rv = handler(**payload['view_args'])
+        except Exception as e:
+            # Same error responses as the view would get in a request
+            rv = app.handle_user_exception(e)
+        return make_response(rv), g.get('user')
+
+
+def finish(id, status, status_code, url='', user=None):
+    """Record the result of a job, all its fields change at once"""
+    result = {'status': status, 'status_code': status_code, 'url': url,
+              'finished': time.time()}
+    if user:
+        result['user'] = user
+    update(id, lambda job: job.update(result))
+
+
+def summary(job):
+    """Status, url and status code of a job as shown by the api"""
+    if job.get('status') == 'pending':
+        return {'status': 'pending'}
+    return {'status': job.get('status'), 'url': job.get('url'),
+            'status_code': int(job.get('status_code') or 500)}
+
+
+def summaries(ids, entries=None):
+    """Status, url and status code of each of the given jobs
+
+    entries are the entries below queue/ (eg. from a mirror), they are
+    read from Consul with one recursive read when not given. Unknown jobs
+    get None.
+    """
+    jobs = scan(entries)
+    result = {}
+    for id in ids:
+        record = jobs.get(id)
+        if record is None or record['job'] is None:
+            result[id] = None
+        else:
+            result[id] = summary(record['job'])
+    return result
+
+
+def recover(jobs=None):
+    """Resume or fail the pending jobs that no process is running
+
+    Pending jobs whose lock is not held (never claimed, or claimed by a
+    process whose session expired) are submitted to the worker pool, run()
+    then runs them or fails the interrupted ones. Returns the number of
+    jobs submitted.
+    """
+    if jobs is None:
+        jobs = scan()
+    submitted = 0
+    for id, record in jobs.items():
+        job = record['job']
+        if job is None or job.get('status') != 'pending' or record['session']:
+            continue
+        try:
+            workers.pool.submit(functools.partial(run, id))
+        except workers.PoolSaturatedError:
+            break
+        submitted += 1
+    return submitted
+
+
+def sweep(jobs=None, now=None):
+    """Delete the jobs finished more than JOBS_TTL seconds ago
+
+    Finished jobs without a finished time (old records) get the current
+    time, so they expire JOBS_TTL seconds from now. Left over locks of
+    deleted jobs are removed too, with the payloads of the jobs deleted.
+    Returns the number of jobs deleted.
+    """
+    if jobs is None:
+        jobs = scan()
+    now = now or time.time()
+    expired = []
+    for id, record in jobs.items():
+        job = record['job']
+        if job is None:
+            expired.extend([job_key(id), payload_key(id)])
+        elif job.get('status') != 'pending':
+            if 'finished' not in job:
+                try:
+                    update(id, lambda job: job.update(finished=now))
+                except kvstore.KeyDoesNotExist:
+                    pass
+            elif now - float(job['finished']) > JOBS_TTL:
+                expired.extend([job_key(id), payload_key(id)])
+    consul.delete_trees(expired)
+    return len(expired) // 2
+
+
+def maintain():
+    """Recover orphaned jobs and sweep expired ones, in one process only
+
+    Every process calls this periodically, only the one holding the
+    maintenance lock with its session reads the queue. The lock is kept
+    while the session lives and released when it expires, so another
+    process takes over when that one dies. Returns (jobs recovered, jobs
+    deleted), None when another process holds the lock.
+    """
+    if not consul.acquire(MAINTENANCE_LOCK, _owner(), sessions.get()):
+        return None
+    jobs = scan()
+    return recover(jobs), sweep(jobs)
+
+
+class Sessions(object):
+    """Consul session of this process, renewed by a daemon thread
+
+    A new session is created on first use after the previous one expired.
+    """
+
+    def __init__(self, name, ttl):
+        self.name = name
+        self.ttl = ttl
+        self.id = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def get(self):
+        with self._lock:
+            if self.id is None:
+                self.id = consul.create_session(self.name, self.ttl)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._renew)
+                self._thread.daemon = True
+                self._thread.start()
+            return self.id
+
+    def _renew(self):
+        while True:
+            time.sleep(consul.duration(self.ttl) / 2)
+            session = self.id
+            if session is None:
+                continue
+            try:
+                if not consul.renew_session(session):
+                    app.logger.warn('Session {} expired'.format(session))
+                    with self._lock:
+                        if self.id == session:
+                            self.id = None
+            except Exception as e:
+                app.logger.error('Unable to renew session {}: {}'
+                                 .format(session, e))
+
+
+sessions = Sessions('paas-jobs', SESSION_TTL)
+_recovery_lock = threading.Lock()
+_recovery_thread = None
+
+
+def start():
+    """Maintain the job queue every RECOVERY_INTERVAL, see maintain()"""
+    global _recovery_thread
+    with _recovery_lock:
+        if _recovery_thread is None:
+            _recovery_thread = threading.Thread(target=_maintain)
+            _recovery_thread.daemon = True
+            _recovery_thread.start()
+
+
+def _maintain():
+    while True:
+        try:
+            (recovered, deleted) = maintain() or (0, 0)
+            if recovered:
+                app.logger.info('Resuming {} orphaned jobs'.format(recovered))
+            if deleted:
+                app.logger.info('Deleted {} expired jobs'.format(deleted))
+        except Exception as e:
+            app.logger.error('Unable to maintain the job queue: {}'.format(e))
+        time.sleep(RECOVERY_INTERVAL)
+
+
+def _owner():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+@app.before_first_request
+def start_recovery():
+    start()
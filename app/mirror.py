@@ -0,0 +1,139 @@
+import bisect
+import threading
+import time
+
+import registry
+
+from . import app
+from . import consul
+
+
+class Mirror(object):
+    """In-memory copy of a registry subtree kept up to date by a watcher
+
+    A daemon thread loads the subtree with one recursive read and then
+    follows it with Consul blocking queries (?index=&wait=). Each answer
+    contains the whole subtree: the entries whose ModifyIndex changed and
+    the keys that disappeared are applied to the copy and passed to the
+    listeners registered with subscribe().
+
+    Consul answers a blocking query as soon as something changes, or after
+    `wait` when nothing did, so while the watcher is healthy the time since
+    the last answer (staleness()) stays below `wait`. fresh() is False when
+    it goes beyond `max_staleness` and readers should go to Consul instead.
+    """
+
+    def __init__(self, prefix, wait='30s', max_staleness=45):
+        self.prefix = prefix
+        self.wait = wait
+        self.max_staleness = max_staleness
+        self.index = None
+        self.synced = None
+        self.updates = 0
+        self.errors = 0
+        # (entries by key, sorted keys) swapped as a whole on every update
+        self._state = ({}, [])
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """Start the watcher thread if it is not running yet"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._watch)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def staleness(self):
+        """Seconds since the copy was last confirmed by Consul"""
+        if self.synced is None:
+            return None
+        return time.time() - self.synced
+
+    def fresh(self):
+        """Whether the copy can be used to answer requests"""
+        staleness = self.staleness()
+        return staleness is not None and staleness <= self.max_staleness
+
+    def entries(self, prefix='', start=None):
+        """Iterate over the entries (Key, Value, ModifyIndex) below prefix
+
+        Entries come in key order starting at the first key not lower than
+        start, from the copy that was current when iteration started.
+        """
+        entries, keys = self._state
+        i = bisect.bisect_left(keys, max(prefix, start or ''))
+        while i < len(keys) and keys[i].startswith(prefix):
+            yield entries[keys[i]]
+            i += 1
+
+    def subscribe(self, listener):
+        """Call listener(changed, removed) after every update
+
+        changed is a list of the entries added or modified and removed a
+        list of the keys deleted. Listeners run in the watcher thread and
+        are not called for the initial load of the subtree.
+        """
+        self._listeners.append(listener)
+
+    def info(self):
+        return {'prefix': self.prefix, 'index': self.index,
+                'keys': len(self._state[1]), 'staleness': self.staleness(),
+                'updates': self.updates, 'errors': self.errors}
+
+    def _watch(self):
+        index = None
+        while True:
+            try:
+                entries, new_index = consul.read(
+                    self.prefix, recurse=True, index=index, wait=self.wait)
+            except Exception as e:
+                self.errors += 1
+                app.logger.error('Unable to watch {}: {}'.format(self.prefix, e))
+                time.sleep(5)
+                continue
+            self._apply(entries, new_index)
+            # An index going backwards means Consul was reset: start again
+            if index is not None and new_index < index:
+                new_index = 0
+            index = new_index or None
+
+    def _apply(self, entries, index):
+        current = {e['Key']: {'Key': e['Key'], 'Value': e['Value'],
+                              'ModifyIndex': e['ModifyIndex']}
+                   for e in entries}
+        previous = self._state[0]
+        changed = [e for k, e in current.items()
+                   if k not in previous or
+                   previous[k]['ModifyIndex'] != e['ModifyIndex']]
+        removed = [k for k in previous if k not in current]
+        if changed or removed:
+            self._state = (current, sorted(current))
+            self.updates += 1
+        initial = self.synced is None
+        self.index = index
+        self.synced = time.time()
+        if (changed or removed) and not initial:
+            for listener in self._listeners:
+                try:
+                    listener(changed, removed)
+                except Exception as e:
+                    app.logger.error('Mirror listener failed: {}'.format(e))
+
+
+instances = Mirror(registry.PREFIX + '/',
+                   wait=app.config.get('MIRROR_WAIT', '30s'),
+                   max_staleness=app.config.get('MIRROR_MAX_STALENESS', 45))
+
+
+def use_instances_mirror():
+    """Whether cluster reads can be answered from the instances mirror
+
+    The watcher is started on first use, so every worker process gets its
+    own one after forking.
+    """
+    if not app.config.get('MIRROR_INSTANCES'):
+        return False
+    instances.start()
+    return instances.fresh()
@@ -0,0 +1,102 @@
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.compat import urlparse
+
+from . import app
+
+
+class SessionPool(object):
+    """Keep-alive HTTP sessions shared by all the outbound calls
+
+    One requests.Session is kept per scheme://host:port, each one with a
+    connection pool of `pool_size` connections, so consecutive calls to
+    Consul, the Mesos framework or the orchestrator reuse TCP connections
+    instead of doing a new handshake every time. Requests get `timeout`
+    seconds unless the caller gives its own timeout.
+    """
+
+    def __init__(self, pool_size=10, timeout=10):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._sessions = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def session(self, url):
+        """Session used for the host of the given url"""
+        host = _host(url)
+        session = self._sessions.get(host)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(host)
+                if session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1,
+                                          pool_maxsize=self.pool_size)
+                    session.mount(host, adapter)
+                    self._stats[host] = {'requests': 0, 'errors': 0}
+                    self._sessions[host] = session
+        return session
+
+    def request(self, method, url, **kwargs):
+        """Send a request through the session of the host of url"""
+        kwargs.setdefault('timeout', self.timeout)
+        session = self.session(url)
+        stats = self._stats[_host(url)]
+        with self._lock:
+            stats['requests'] += 1
+        try:
+            return session.request(method, url, **kwargs)
+        except requests.RequestException:
+            with self._lock:
+                stats['errors'] += 1
+            raise
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def info(self):
+        """Per host request counters and connection pool usage
+
+        connections is the number of TCP connections opened so far, when it
+        stays well below requests the connections are being reused.
+        """
+        info = {}
+        with self._lock:
+            sessions = [(host, session, dict(self._stats[host]))
+                        for host, session in self._sessions.items()]
+        for host, session, stats in sessions:
+            connections = 0
+            for adapter in session.adapters.values():
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    connections += pools[key].num_connections
+            stats['connections'] = connections
+            stats['pool_size'] = self.pool_size
+            info[host] = stats
+        return info
+
+
+def _host(url):
+    parts = urlparse(url)
+    return '{}://{}'.format(parts.scheme, parts.netloc)
+
+
+pool = SessionPool(pool_size=app.config.get('OUTBOUND_POOL_SIZE', 10),
+                   timeout=app.config.get('OUTBOUND_TIMEOUT', 10))
+
+get = pool.get
+post = pool.post
+put = pool.put
+delete = pool.delete
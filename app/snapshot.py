@@ -0,0 +1,261 @@
+from flask import g, has_request_context
+import kvstore
+import registry
+
+from . import consul
+from . import mirror
+
+# Number of fields of a cluster DN: <prefix>/<user>/<product>/<version>/<id>
+CLUSTER_DN_FIELDS = len(registry.PREFIX.split('/')) + 4
+
+
+class Record(object):
+    """In-memory view of a registry entry built from a recursive read
+
+    Offers the same attribute interface as the registry proxies, so it can
+    be used wherever a read-only proxy is expected, but the attributes are
+    served from the values already loaded instead of one GET per attribute.
+    """
+
+    def __init__(self, dn, attributes=None, index=0):
+        self.dn = dn
+        self.attributes = attributes if attributes is not None else {}
+        # Highest ModifyIndex seen in the subtree of the entry
+        self.index = index
+        # Nested records by container, eg. {'nodes': {'node0': Record}}
+        self.children = {}
+
+    def child(self, container, name):
+        """Get or create the nested record container/name"""
+        records = self.children.setdefault(container, {})
+        record = records.get(name)
+        if record is None:
+            record = records[name] = Record(
+                '{}/{}/{}'.format(self.dn, container, name))
+        return record
+
+    def subrecords(self, container):
+        """Nested records of a container (eg. nodes) sorted by name"""
+        records = self.children.get(container, {})
+        return [records[name] for name in sorted(records)]
+
+    @property
+    def name(self):
+        return registry.parse_last_field(self.dn)
+
+    def __getattr__(self, name):
+        try:
+            # Read through __dict__ to avoid recursion before __init__
+            return self.__dict__['attributes'][name]
+        except KeyError:
+            raise registry.KeyDoesNotExist(
+                'Key {}/{} does not exist'.format(self.dn, name))
+
+    def get(self, name, default=None):
+        return self.attributes.get(name, default)
+
+    def __repr__(self):
+        return 'Record({})'.format(self.dn)
+
+
+def cluster_prefix(user=None, product=None, version=None):
+    """Registry prefix holding the clusters that match the given filters
+
+    As with registry.query_clusters() the filters apply hierarchically.
+    The prefix ends with a slash so that eg. user "test" does not match the
+    clusters of user "test2".
+    """
+    prefix = registry.PREFIX
+    for field in (user, product, version):
+        if not field:
+            break
+        prefix = '{}/{}'.format(prefix, field)
+    return prefix + '/'
+
+
+def iter_clusters(user=None, product=None, version=None, after=None):
+    """Iterate over the clusters matching the filters in registry key order
+
+    Clusters are decoded while they are read. When after (a cluster DN) is
+    given, the clusters up to it are skipped without decoding them, which
+    is what allows listings to be paginated.
+    """
+    # Keys of a cluster start with "<dn>/" and "0" is the next character
+    start = after + '0' if after else None
+    return decode_clusters(_read(cluster_prefix(user, product, version), start))
+
+
+def load_clusters(user=None, product=None, version=None):
+    """Load the clusters matching the filters with a single recursive read"""
+    return list(iter_clusters(user, product, version))
+
+
+def load_cluster(user, product, version, id, attributes=None):
+    """Load the record of a cluster with a single recursive read
+
+    When only some attributes are needed (eg. ['status']) and the mirror
+    cannot be used, only those keys are read instead of the whole subtree,
+    plus a keys-only read when none of them exists to tell a missing
+    cluster from missing attributes. Raises KeyDoesNotExist when the
+    cluster does not exist, missing attributes of an existing cluster
+    raise KeyDoesNotExist when they are read, like the registry proxies.
+    """
+    dn = '{}{}'.format(cluster_prefix(user, product, version), id)
+    if attributes is None or mirror.use_instances_mirror():
+        entries = list(_read(dn + '/'))
+        exists = bool(entries)
+    else:
+        entries = []
+        for attribute in sorted(attributes):
+            (found, consul_index) = consul.read('{}/{}'.format(dn, attribute))
+            entries.extend(found)
+            record_index(consul_index)
+        exists = bool(entries)
+        if not exists:
+            (keys, consul_index) = consul.read(dn + '/', recurse=True, keys=True)
+            exists = bool(keys)
+            record_index(consul_index)
+    if not exists:
+        raise kvstore.KeyDoesNotExist('Cluster {} does not exist'.format(dn))
+    return next(decode_clusters(entries), Record(dn))
+
+
+def load_cluster_tree(user, product, version, id, containers=None):
+    """Load a cluster with its nodes, services, disks and networks
+
+    The subtree of the cluster is read with a single recursive read and
+    decoded into nested records, eg. cluster.subrecords('nodes'). When
+    containers is given only those are loaded: ['nodes'] loads the nodes
+    with their attributes, ['nodes', 'nodes/disks'] their disks too. Each
+    top level container is one recursive read of its subtree, Consul cannot
+    leave the nested containers out of it but their entries are skipped
+    without decoding them.
+    """
+    dn = '{}{}'.format(cluster_prefix(user, product, version), id)
+    if containers is None:
+        entries = list(_read(dn + '/'))
+    else:
+        entries = []
+        for container in sorted(set(c.split('/')[0] for c in containers)):
+            entries.extend(_read('{}/{}/'.format(dn, container)))
+    if not entries:
+        raise kvstore.KeyDoesNotExist('Cluster {} does not exist'.format(dn))
+    return decode_tree(dn, entries, containers)
+
+
+def decode_tree(dn, entries, containers=None):
+    """Build the tree of records stored below dn
+
+    Keys follow the <container>/<name>/.../<attribute> layout used by the
+    registry, eg. nodes/node0/disks/disk1/destination, and lists are stored
+    as <container>/<name> keys with empty values (eg. services/x/nodes/y).
+    Folder keys (ending with a slash, eg. nodes/ or nodes/node0/) add the
+    records of their path but no attribute, as the registry proxies do.
+    When containers is given (eg. ['nodes', 'nodes/disks']) the records of
+    other containers are skipped.
+    """
+    root = Record(dn)
+    for e in entries:
+        parts = e['Key'][len(dn) + 1:].split('/')
+        folder = not parts[-1]
+        if folder:
+            parts = parts[:-1]
+        if not parts:
+            continue
+        if containers is not None and len(parts) > 1:
+            # Container path of the deepest record, eg. nodes/disks
+            record_parts = parts[:len(parts) // 2 * 2]
+            if '/'.join(record_parts[::2]) not in containers:
+                continue
+        root.index = max(root.index, e['ModifyIndex'])
+        record = root
+        while len(parts) > 2:
+            record = record.child(parts[0], parts[1])
+            parts = parts[2:]
+        if len(parts) == 2:
+            record.child(parts[0], parts[1])
+        elif not folder:
+            record.attributes[parts[0]] = e['Value']
+    return root
+
+
+def to_dict(record, proxy_class):
+    """Serialize a record like proxy_class.to_dict() does (eg. registry.Node)"""
+    data = {k: record.get(k) for k in proxy_class.__serializable__}
+    data.update(dn=record.dn, name=record.name)
+    return data
+
+
+def cluster_fields(dn):
+    """Split a cluster DN into its (user, product, version, id) fields"""
+    return tuple(dn.split('/')[CLUSTER_DN_FIELDS - 4:CLUSTER_DN_FIELDS])
+
+
+def index(prefix):
+    """Consul index of the registry data below prefix, if it costs nothing
+
+    Keys of the instances tree use the index of the instances mirror when
+    it is up to date, it covers the whole tree so it changes more often
+    than the index of prefix would, but it costs no request. Otherwise
+    None is returned: reading the index would be a request of its own, so
+    the index of the read done by the view (see record_index) is used.
+    """
+    if prefix.startswith(mirror.instances.prefix) and mirror.use_instances_mirror():
+        g.registry_staleness = mirror.instances.staleness()
+        return mirror.instances.index
+    return None
+
+
+def record_index(consul_index):
+    """Keep the Consul index of a registry read done by the current request
+
+    conditional() builds the ETag of the response from the highest one when
+    the index was not available before the view ran.
+    """
+    if has_request_context():
+        g.registry_index = max(g.get('registry_index') or 0, consul_index)
+
+
+def _read(prefix, start=None):
+    """Read the entries of a subtree of the instances tree in key order
+
+    The read is served by the instances mirror when it is up to date, its
+    staleness is then recorded in g.registry_staleness. Entries with keys
+    lower than start are skipped.
+    """
+    if mirror.use_instances_mirror():
+        g.registry_staleness = mirror.instances.staleness()
+        return mirror.instances.entries(prefix, start)
+    entries, consul_index = consul.read(prefix, recurse=True)
+    record_index(consul_index)
+    if start:
+        entries = [e for e in entries if e['Key'] >= start]
+    return entries
+
+
+def decode_clusters(entries):
+    """Group a flat listing of registry entries into cluster records
+
+    Entries must come in key order, as Consul returns them, so that the
+    keys of each cluster are consecutive. Records are yielded as soon as
+    all the keys of the cluster have been seen.
+
+    Only the attributes stored directly under each cluster DN (eg. status or
+    dnsname) are kept, the nodes and services subtrees are skipped but they
+    count for the index of the record.
+    """
+    record = None
+    for e in entries:
+        fields = e['Key'].split('/')
+        if len(fields) < CLUSTER_DN_FIELDS or not fields[CLUSTER_DN_FIELDS - 1]:
+            continue
+        dn = '/'.join(fields[:CLUSTER_DN_FIELDS])
+        if record is None or record.dn != dn:
+            if record is not None:
+                yield record
+            record = Record(dn)
+        if len(fields) == CLUSTER_DN_FIELDS + 1 and fields[-1]:
+            record.attributes[fields[-1]] = e['Value']
+        record.index = max(record.index, e['ModifyIndex'])
+    if record is not None:
+        yield record
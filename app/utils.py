@@ -1,8 +1,15 @@
+import base64
+import binascii
+import itertools
+import json
 import registry
 import threading
 import time
-import requests
+from flask import Response, request, stream_with_context
 from . import app
+from . import outbound
+from . import snapshot
+from .errors import ValidationError
 
 ORCHESTRATOR_ENDPOINT = app.config.get('ORCHESTRATOR_ENDPOINT')
 
@@ -25,17 +32,25 @@ def trim_dn(username, version, framework, dn):
     return dn
 
 
-def print_full_instance(instance):
+# Fields of the cluster data and the registry attribute they come from
+CLUSTER_FIELDS = (('name', 'dnsname'), ('dn', None), ('status', 'status'))
+
+
+def cluster_attributes(fields):
+    """Registry attributes needed to return the given cluster fields"""
+    return [attribute for field, attribute in CLUSTER_FIELDS
+            if attribute and (fields is None or field in fields)]
+
+
+def print_full_instance(instance, fields=None):
     """ Try to get all the info from an instance or if error, return the dn"""
     try:
         return {
             "result": "success",
             "uri": str(instance.dn).replace("instances", "clusters"),
-            "data": {
-                "name": instance.dnsname,
-                "dn": instance.dn,
-                "status": instance.status
-            }
+            "data": {field: getattr(instance, attribute) if attribute else instance.dn
+                     for field, attribute in CLUSTER_FIELDS
+                     if fields is None or field in fields}
         }
     except registry.KeyDoesNotExist as e:
         return {
@@ -45,6 +60,41 @@ def print_full_instance(instance):
         }
 
 
+def requested_fields(allowed):
+    """Set of fields requested with ?fields=a,b or None to return them all"""
+    fields = request.args.get('fields')
+    if not fields:
+        return None
+    fields = set(f.strip() for f in fields.split(',') if f.strip())
+    unknown = fields - set(allowed)
+    if unknown:
+        raise ValidationError('unknown fields: {}; valid fields: {}'.format(
+            ', '.join(sorted(unknown)), ', '.join(allowed)))
+    return fields
+
+
+def int_arg(name):
+    """Integer value of the query parameter name, None when not given
+
+    request.args.get(name, type=int) gives None for values that do not
+    parse, they would be taken as not given.
+    """
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise ValidationError('{} must be an integer: {}'.format(name, value))
+
+
+def project(data, fields):
+    """Keep only the requested fields of a dict"""
+    if fields is None:
+        return data
+    return {k: v for k, v in data.items() if k in fields}
+
+
 def print_instance(instance, filters):
     """ Try to get the basic info from the instance or if error, return the dn"""
     (username, service, version) = filters
@@ -69,6 +119,58 @@ def print_instance(instance, filters):
         }
 
 
+def stream_list(name, items, extra=None):
+    """Response with the JSON document {name: [items], **extra} streamed
+
+    Items are serialized and sent one by one while they are consumed from
+    the iterable, so neither the list nor the whole JSON string has to be
+    built in memory before the first byte is sent.
+    """
+    # The first item is produced before the response starts, so that
+    # errors reading the backend still give a proper error response
+    items = iter(items)
+    first = list(itertools.islice(items, 1))
+
+    def generate():
+        yield '{{{}: ['.format(json.dumps(name))
+        for i, item in enumerate(itertools.chain(first, items)):
+            yield (', ' if i else '') + json.dumps(item)
+        yield ']'
+        for k, v in (extra or {}).items():
+            yield ', {}: {}'.format(json.dumps(k), json.dumps(v))
+        yield '}\n'
+    return Response(stream_with_context(generate()),
+                    mimetype='application/json')
+
+
+def filter_clusters(clusters, status=None, product=None, since=None):
+    """Filter cluster records by status, product and Consul index
+
+    since keeps only the clusters modified after the given Consul index.
+    """
+    for cluster in clusters:
+        if status is not None and cluster.get('status') != status:
+            continue
+        if product is not None and snapshot.cluster_fields(cluster.dn)[1] != product:
+            continue
+        if since is not None and cluster.index <= since:
+            continue
+        yield cluster
+
+
+def encode_cursor(dn):
+    """Opaque pagination cursor pointing after the given cluster"""
+    return base64.urlsafe_b64encode(dn)
+
+
+def decode_cursor(cursor):
+    """DN of the last cluster returned in the previous page"""
+    try:
+        return base64.urlsafe_b64decode(str(cursor))
+    except (TypeError, binascii.Error):
+        raise ValidationError('invalid cursor: {}'.format(cursor))
+
+
 def launch_orchestrator_when_ready(clusterdn):
     """Launch the orchestrator process"""
     cluster = registry.get_cluster(dn=clusterdn)
@@ -84,7 +186,7 @@ def launch_orchestrator_when_ready(clusterdn):
         #app.logger.info('Waiting 20s for containers to boot')
         #time.sleep(20)
         app.logger.info('Launching orchestrator')
-        requests.post('{}/{}'.format(ORCHESTRATOR_ENDPOINT, clusterid))
+        outbound.post('{}/{}'.format(ORCHESTRATOR_ENDPOINT, clusterid))
 
     t = threading.Thread(target=orchestrate_when_cluster_is_ready)
     t.daemon = True
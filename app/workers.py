@@ -0,0 +1,109 @@
+import collections
+import math
+import Queue
+import threading
+import time
+
+from . import app
+
+
+class PoolSaturatedError(Exception):
+    pass
+
+
+class WorkerPool(object):
+    """Fixed number of worker threads consuming a bounded queue of jobs
+
+    submit() never blocks: when `queue_size` jobs are already waiting it
+    raises PoolSaturatedError so the caller can ask the client to retry
+    later instead of piling up threads. The workers are started on first
+    use, so every worker process gets its own ones after forking. Each job
+    run counts either as completed or as failed (it raised).
+    """
+
+    def __init__(self, workers=8, queue_size=32):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.active = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        # Seconds waited in the queue and spent running of the last jobs
+        self._waits = collections.deque(maxlen=100)
+        self._durations = collections.deque(maxlen=100)
+        self._queue = Queue.Queue(maxsize=queue_size)
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the worker threads if they are not running yet"""
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def full(self):
+        return self._queue.full()
+
+    def reject(self):
+        """Count a job turned away because the queue was full"""
+        with self._lock:
+            self.rejected += 1
+
+    def submit(self, function):
+        """Queue function() to be run by a worker"""
+        self.start()
+        try:
+            self._queue.put_nowait((function, time.time()))
+        except Queue.Full:
+            raise PoolSaturatedError('{} jobs already waiting'
+                                     .format(self.queue_size))
+        with self._lock:
+            self.submitted += 1
+
+    def retry_after(self):
+        """Estimated seconds until a queued job would start running"""
+        durations = list(self._durations)
+        if not durations:
+            return 1
+        average = sum(durations) / len(durations)
+        waiting = self._queue.qsize() + 1
+        return max(1, int(math.ceil(average * waiting / self.workers)))
+
+    def info(self):
+        waits = list(self._waits)
+        return {'workers': self.workers, 'active': self.active,
+                'queue_depth': self._queue.qsize(),
+                'queue_size': self.queue_size,
+                'submitted': self.submitted, 'rejected': self.rejected,
+                'completed': self.completed, 'failed': self.failed,
+                'wait_avg': sum(waits) / len(waits) if waits else 0,
+                'wait_max': max(waits) if waits else 0}
+
+    def _work(self):
+        while True:
+            (function, queued) = self._queue.get()
+            start = time.time()
+            self._waits.append(start - queued)
+            with self._lock:
+                self.active += 1
+            try:
+                function()
+                failed = False
+            except Exception as e:
+                failed = True
+                app.logger.exception('Asynchronous job failed: {}'.format(e))
+            with self._lock:
+                self.active -= 1
+                if failed:
+                    self.failed += 1
+                else:
+                    self.completed += 1
+            self._durations.append(time.time() - start)
+
+
+pool = WorkerPool(workers=app.config.get('WORKER_THREADS', 8),
+                  queue_size=app.config.get('WORKER_QUEUE_SIZE', 32))
@@ -4,6 +4,10 @@
 SECRET = '/etc/keyczar/keys'
 # Secret keyczar keys
 SECRET_KEYS = '/etc/keyczar/keys'
+# Seconds between checks of the keys directory for key rotations
+SECRET_KEYS_RELOAD_INTERVAL = 60
+# Maximum number of verified tokens kept in memory
+TOKEN_CACHE_SIZE = 1024
 # Fill as needed
 DEBUG = True
 IGNORE_AUTH = False
@@ -11,3 +15,55 @@ IGNORE_AUTH = False
 MESOS_FRAMEWORK_ENDPOINT = 'http://framework:6001/bigdata/mesos_framework/v1/clusters'
 ORCHESTRATOR_ENDPOINT = 'http://orchestrator:6002/v1/clusters'
 CONSUL_ENDPOINT = 'http://consul:8500/v1/kv'
+# Connections kept alive per outbound host (Consul, framework, orchestrator)
+# and default timeout in seconds of the outbound requests
+OUTBOUND_POOL_SIZE = 10
+OUTBOUND_TIMEOUT = 10
+# Seconds a cached product is served before checking its Consul index
+PRODUCT_CACHE_TTL = 30
+# Compiled product templates kept in memory
+TEMPLATE_CACHE_SIZE = 128
+# Reports of POST /products/<name>/<version>/render kept in memory
+DRY_RUN_CACHE_SIZE = 64
+# Renders looping more than RENDER_MAX_ITERATIONS times in total (eg. nodes
+# times disks) or giving clusters of more than CLUSTER_MAX_KEYS keys are
+# rejected with a 400
+RENDER_MAX_ITERATIONS = 50000
+CLUSTER_MAX_KEYS = 50000
+# Serve cluster reads from an in-memory mirror of the instances tree
+# kept up to date with Consul blocking queries of MIRROR_WAIT. Reads go
+# to Consul when the mirror has not heard from it in MIRROR_MAX_STALENESS
+# seconds.
+MIRROR_INSTANCES = True
+MIRROR_WAIT = '30s'
+MIRROR_MAX_STALENESS = 45
+# Maximum limit accepted by the paginated cluster listings
+CLUSTERS_MAX_PAGE_SIZE = 1000
+# Responses of at least COMPRESS_MIN_SIZE bytes are sent with gzip or
+# deflate to the clients that accept it, compressed product documents are
+# kept in a cache of COMPRESS_CACHE_SIZE entries
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_LEVEL = 6
+COMPRESS_CACHE_SIZE = 256
+# Threads running the asynchronous requests (eg. cluster launches) and
+# maximum number of requests waiting for one, beyond that the API answers
+# 503 with a Retry-After header
+WORKER_THREADS = 8
+WORKER_QUEUE_SIZE = 32
+# Asynchronous requests are stored in the KV store and locked with a Consul
+# session of JOBS_SESSION_TTL by the process running them. Every
+# JOBS_RECOVERY_INTERVAL seconds the process holding the maintenance lock
+# resumes the jobs left by stopped processes, or fails them if they had
+# already started, and deletes the jobs finished more than JOBS_TTL
+# seconds ago.
+JOBS_SESSION_TTL = '30s'
+JOBS_RECOVERY_INTERVAL = 60
+JOBS_TTL = 86400
+# Maximum seconds GET /queue/<id>?wait= waits for a job to finish
+QUEUE_MAX_WAIT = 300
+# Maximum number of job ids accepted by POST /queue/status
+QUEUE_STATUS_MAX_IDS = 1000
+# Events kept for a slow client of GET /clusters/<username>/events before
+# its stream is closed, and seconds between keepalives of idle streams
+EVENTS_QUEUE_SIZE = 100
+EVENTS_HEARTBEAT = 15
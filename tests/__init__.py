@@ -0,0 +1,4 @@
+import os
+
+# The app reads config/<FLASK_CONFIG>.py when it is imported
+os.environ.setdefault('FLASK_CONFIG', 'testing')
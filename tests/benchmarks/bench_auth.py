@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""Microbenchmark of the authentication overhead of a protected endpoint
+
+Measures requests/sec of GET /products served through the Flask test client,
+and the latency of the restricted() decorator alone, with a real keyczar
+keyset: reading the keyset on every request (previous
+behaviour), with the process wide keyring and with the verified token cache.
+
+Run from the repository root:
+
+    FLASK_CONFIG=testing python tests/benchmarks/bench_auth.py
+"""
+import base64
+import hashlib
+import shutil
+import sys
+import tempfile
+import time
+
+from flask import g
+from keyczar import keyczart
+from keyczar.keyczar import Crypter
+
+sys.path.insert(0, '.')
+from app import app, decorators, snapshot
+from app.catalog import product_index
+from app.cache import LRUCache
+from app.credentials import Keyring
+
+URL = '/bigdata/api/v1/products'
+REQUESTS = 2000
+# Whether g.passwd is read on every request, emulating eager decryption
+EAGER = [False]
+
+
+class UncachedKeyring(Keyring):
+    """Reads the keyset from disk on every decryption"""
+    def decrypt(self, ciphertext):
+        return Crypter.Read(self.location).Decrypt(ciphertext)
+
+
+def create_keyset():
+    location = tempfile.mkdtemp()
+    keyczart.main(['create', '--location=' + location, '--purpose=crypt'])
+    keyczart.main(['addkey', '--location=' + location, '--status=primary'])
+    return location
+
+
+def make_token(location, user='test', passwd='secret', role='ROLE_USER'):
+    encrypted = Crypter.Read(location).Encrypt(passwd)
+    expires = str(int((time.time() + 3600) * 1000))
+    subject = ':'.join([base64.b64encode(user), encrypted,
+                        base64.b64encode(role), expires])
+    signature = hashlib.md5(subject + ':' + location).hexdigest()
+    return subject + ':' + signature
+
+
+@app.after_request
+def read_passwd(response):
+    if EAGER[0]:
+        g.passwd
+    return response
+
+
+def run(client, token):
+    start = time.time()
+    for _ in range(REQUESTS):
+        rv = client.get(URL, headers={'x-auth-token': token})
+        assert rv.status_code == 200, rv.data
+    return REQUESTS / (time.time() - start)
+
+
+def auth_latency(token):
+    """Average microseconds spent by restricted() around an empty view"""
+    view = decorators.restricted(role='ROLE_USER')(
+        lambda: g.passwd if EAGER[0] else '')
+    with app.test_request_context(URL, headers={'x-auth-token': token}):
+        start = time.time()
+        for _ in range(REQUESTS):
+            view()
+        return (time.time() - start) / REQUESTS * 1e6
+
+
+def main():
+    location = create_keyset()
+    try:
+        # Keep Consul out of the measurement
+        product_index.get = lambda: {}
+        snapshot.index = lambda prefix: 0
+        decorators.KEYS = location
+        token = make_token(location)
+        client = app.test_client()
+        for name, keyring, cache_size, eager in (
+                ('Crypter.Read per request', UncachedKeyring, 0, True),
+                ('keyring, eager decryption', Keyring, 0, True),
+                ('keyring, lazy decryption', Keyring, 0, False),
+                ('verified token cache', Keyring, 1024, False)):
+            EAGER[0] = eager
+            decorators.keyring = keyring(location, interval=0)
+            decorators.token_cache = LRUCache(maxsize=cache_size)
+            run(client, token)  # warm up
+            print('{:<28} {:8.0f} req/s {:8.1f} us/auth'.format(
+                name, run(client, token), auth_latency(token)))
+    finally:
+        shutil.rmtree(location)
+
+
+if __name__ == '__main__':
+    main()
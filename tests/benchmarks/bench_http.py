@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""Benchmark of the outbound HTTP calls against a local stand-in server
+
+Sends the same POST used to submit clusters to the Mesos framework with the
+module level requests API (a new connection per call, previous behaviour)
+and through the pooled keep-alive sessions of app.outbound, from one and
+from several threads.
+
+Run from the repository root:
+
+    FLASK_CONFIG=testing python tests/benchmarks/bench_http.py
+"""
+import sys
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+import requests
+
+sys.path.insert(0, '.')
+from app import outbound
+
+CALLS = 1000
+THREADS = 8
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Stand-in framework endpoint that keeps connections alive"""
+    protocol_version = 'HTTP/1.1'
+    # Send each response in a single segment like a real server would
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write('{}')
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def run(post, url, threads):
+    def worker():
+        for _ in range(CALLS // threads):
+            assert post(url, json={'clusterdn': 'instances/x'}).status_code == 200
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.time()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return CALLS / (time.time() - start)
+
+
+def main():
+    server = Server(('127.0.0.1', 0), Handler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    url = 'http://127.0.0.1:{}/clusters'.format(server.server_address[1])
+
+    for threads in (1, THREADS):
+        for name, post in (('requests.post', requests.post),
+                           ('outbound.post', outbound.post)):
+            print('{:<14} {} thread(s) {:8.0f} calls/s'.format(
+                name, threads, run(post, url, threads)))
+    print(outbound.pool.info())
+    outbound.pool.session(url).close()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""Benchmark of the rendering done when a cluster is instantiated
+
+Renders the Cassandra template in tests/cassandra and flattens the result
+into the keys written to Consul, compiling the template on every launch
+(previous behaviour) and with the compiled template cache of
+app.instantiation. Consul is not involved.
+
+Run from the repository root:
+
+    FLASK_CONFIG=testing python tests/benchmarks/bench_render.py
+"""
+import sys
+import time
+
+import jinja2
+import registry
+
+sys.path.insert(0, '.')
+from app import instantiation
+from app.catalog import ProductRecord
+
+RENDERS = 2000
+DN = 'clusters/test/cassandra/3.0.8/1'
+
+
+class UncachedTemplates(instantiation.TemplateCache):
+    """Compiles the template on every call"""
+    def get(self, product, version, source):
+        self.compilations += 1
+        return jinja2.Template(source)
+
+
+def load_product():
+    with open('tests/cassandra/template.json') as f:
+        template = f.read()
+    with open('tests/cassandra/options.json') as f:
+        options = f.read()
+    return ProductRecord('products/cassandra/3.0.8', {
+        'template': template, 'templatetype': 'json+jinja2',
+        'options': options})
+
+
+def run(product_doc, opts):
+    start = time.time()
+    for _ in range(RENDERS):
+        data = instantiation.render(product_doc, opts, 'test', 'cassandra',
+                                    '3.0.8', DN)
+        kvinfo = {}
+        registry._populate(kvinfo, using=data, prefix=DN)
+    return RENDERS / (time.time() - start), len(kvinfo)
+
+
+def main():
+    product_doc = load_product()
+    opts = dict(product_doc.schema.defaults)
+    for name, cache in (('compile per launch', UncachedTemplates()),
+                        ('compiled template cache', instantiation.TemplateCache())):
+        instantiation.templates = cache
+        run(product_doc, opts)  # warm up
+        rate, keys = run(product_doc, opts)
+        print('{:<24} {:8.0f} renders/s ({} keys) {}'.format(
+            name, rate, keys, cache.info()))
+
+
+if __name__ == '__main__':
+    main()
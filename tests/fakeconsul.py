@@ -0,0 +1,264 @@
+"""In-memory stand-in for the Consul HTTP API used by the unit tests
+
+FakeConsul replaces the request method of the outbound session pool, so
+every call made through app.outbound (the KV, transaction and session
+APIs) is answered from a dict instead of going to the network. Requests
+to other hosts (eg. the Mesos framework) get a 200 with an empty object.
+"""
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+import unittest
+import urlparse
+import uuid
+
+import registry
+
+from app import app, catalog, consul, instantiation, jobs, outbound, utils
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+
+
+class Response(object):
+
+    def __init__(self, status_code, body=None, index=0):
+        self.status_code = status_code
+        self.body = body
+        self.headers = {'X-Consul-Index': str(index)}
+
+    def json(self):
+        return self.body
+
+    @property
+    def text(self):
+        return json.dumps(self.body)
+
+
+class FakeConsul(object):
+
+    def __init__(self):
+        # key -> {'Value', 'CreateIndex', 'ModifyIndex', 'Session'}
+        self.store = {}
+        self.sessions = set()
+        self.index = 1
+        self.requests = []
+        # Number of transactions to accept before failing the next one
+        self.fail_txn_after = None
+        self.other = lambda method, url, **kwargs: Response(200, {})
+        self._cond = threading.Condition(threading.RLock())
+        self._request = None
+
+    def install(self):
+        self._request = outbound.pool.request
+        outbound.pool.request = self.request
+        return self
+
+    def uninstall(self):
+        outbound.pool.request = self._request
+
+    def put(self, key, value):
+        with self._cond:
+            self._set(key, value)
+
+    def get(self, key):
+        return self.store[key]['Value']
+
+    def keys(self, prefix=''):
+        return sorted(k for k in self.store if k.startswith(prefix))
+
+    def request(self, method, url, params=None, data=None, json=None, **kwargs):
+        base = consul.CONSUL_ENDPOINT.rsplit('/', 2)[0]
+        if not url.startswith(base):
+            return self.other(method, url, params=params, data=data,
+                              json=json, **kwargs)
+        parts = urlparse.urlparse(url)
+        params = dict(params or {})
+        params.update(urlparse.parse_qsl(parts.query, keep_blank_values=True))
+        params = {k: str(v) for k, v in params.items()}
+        path = parts.path[len('/v1/'):]
+        with self._cond:
+            self.requests.append((method, path, params))
+            if path.startswith('kv/'):
+                return getattr(self, '_kv_' + method.lower())(
+                    path[len('kv/'):], params, data)
+            if path == 'txn':
+                return self._txn(json)
+            if path == 'session/create':
+                session = str(uuid.uuid4())
+                self.sessions.add(session)
+                return Response(200, {'ID': session}, self.index)
+            if path.startswith('session/renew/'):
+                session = path.rsplit('/', 1)[1]
+                if session not in self.sessions:
+                    return Response(404, None, self.index)
+                return Response(200, [{'ID': session}], self.index)
+        return Response(404, None, self.index)
+
+    def _kv_get(self, key, params, data):
+        if params.get('index'):
+            timeout = consul.duration(params.get('wait') or '5m')
+            deadline = time.time() + min(timeout, 5)
+            while self.index <= int(params['index']) and time.time() < deadline:
+                self._cond.wait(deadline - time.time())
+        if 'recurse' in params or 'keys' in params:
+            keys = self.keys(key)
+        else:
+            keys = [key] if key in self.store else []
+        if not keys:
+            return Response(404, None, self.index)
+        if 'keys' in params:
+            return Response(200, keys, self.index)
+        return Response(200, [self._entry(k) for k in keys], self.index)
+
+    def _kv_put(self, key, params, data):
+        current = self.store.get(key)
+        if 'cas' in params:
+            cas = int(params['cas'])
+            if (current is None and cas != 0) or (
+                    current is not None and current['ModifyIndex'] != cas):
+                return Response(200, False, self.index)
+        if 'acquire' in params:
+            session = params['acquire']
+            if session not in self.sessions or (
+                    current is not None and current['Session'] not in (None, session)):
+                return Response(200, False, self.index)
+            self._set(key, data or '', session)
+            return Response(200, True, self.index)
+        if 'release' in params:
+            if current is None or current['Session'] != params['release']:
+                return Response(200, False, self.index)
+            self._set(key, current['Value'], None)
+            return Response(200, True, self.index)
+        self._set(key, data or '')
+        return Response(200, True, self.index)
+
+    def _kv_delete(self, key, params, data):
+        self._delete(self.keys(key) if 'recurse' in params else [key])
+        return Response(200, True, self.index)
+
+    def _txn(self, operations):
+        if len(operations) > consul.TXN_MAX_OPERATIONS:
+            return Response(413, None, self.index)
+        if self.fail_txn_after is not None:
+            if self.fail_txn_after == 0:
+                return Response(500, {'Errors': ['failed']}, self.index)
+            self.fail_txn_after -= 1
+        for op in operations:
+            op = op['KV']
+            if op['Verb'] == 'cas' and (
+                    self.store.get(op['Key'], {}).get('ModifyIndex', 0) != op['Index']):
+                return Response(409, {'Errors': ['cas failed']}, self.index)
+        results = []
+        for op in operations:
+            op = op['KV']
+            if op['Verb'] in ('set', 'cas'):
+                self._set(op['Key'], base64.b64decode(op.get('Value') or ''))
+                results.append({'KV': {'Key': op['Key']}})
+            elif op['Verb'] == 'delete-tree':
+                self._delete(self.keys(op['Key']))
+            elif op['Verb'] == 'delete':
+                self._delete([op['Key']])
+        return Response(200, {'Results': results, 'Errors': None}, self.index)
+
+    def _set(self, key, value, session=False):
+        self.index += 1
+        current = self.store.get(key, {})
+        self.store[key] = {
+            'Value': value, 'CreateIndex': current.get('CreateIndex', self.index),
+            'ModifyIndex': self.index,
+            'Session': current.get('Session') if session is False else session}
+        self._cond.notify_all()
+
+    def _delete(self, keys):
+        for key in keys:
+            self.store.pop(key, None)
+        self.index += 1
+        self._cond.notify_all()
+
+    def _entry(self, key):
+        e = self.store[key]
+        entry = {'Key': key, 'CreateIndex': e['CreateIndex'],
+                 'ModifyIndex': e['ModifyIndex'], 'LockIndex': 0, 'Flags': 0,
+                 'Value': base64.b64encode(e['Value']) if e['Value'] else None}
+        if e['Session']:
+            entry['Session'] = e['Session']
+        return entry
+
+
+class ConsulTestCase(unittest.TestCase):
+    """Test case with a FakeConsul installed and the in-memory caches empty
+
+    The instances mirror is disabled so reads go to the fake.
+    """
+
+    def setUp(self):
+        self.consul = FakeConsul().install()
+        self.addCleanup(self.consul.uninstall)
+        mirror_instances = app.config.get('MIRROR_INSTANCES')
+        app.config['MIRROR_INSTANCES'] = False
+        self.addCleanup(app.config.__setitem__, 'MIRROR_INSTANCES',
+                        mirror_instances)
+        # The session of the jobs belongs to the previous fake
+        jobs.sessions.id = None
+        catalog.products._entries.clear()
+        instantiation.templates._templates.clear()
+        instantiation.dry_runs.clear()
+
+    def register_product(self, name, version, directory):
+        """Register the product in tests/<directory> as name/version"""
+        with open(os.path.join(TESTS, directory, 'template.json')) as f:
+            template = f.read()
+        with open(os.path.join(TESTS, directory, 'options.json')) as f:
+            options = f.read()
+        registry.register(name, version, 'description', template=template,
+                          options=options)
+
+
+def token(user='test', role='ROLE_USER', expires=None):
+    """X-Auth-Token signed like the ones of the authentication service"""
+    expires = expires or time.time() + 3600
+    subject = ':'.join([base64.b64encode(user), 'passwd', base64.b64encode(role),
+                        str(int(expires * 1000))])
+    signature = hashlib.md5(subject + ':' + app.config['SECRET_KEYS'])
+    return subject + ':' + signature.hexdigest()
+
+
+class ApiTestCase(ConsulTestCase):
+    """ConsulTestCase with a test client authenticated as user test"""
+
+    API = '/bigdata/api/v1'
+
+    def setUp(self):
+        super(ApiTestCase, self).setUp()
+        self.client = app.test_client()
+        self.headers = {'X-Auth-Token': token()}
+        # No job maintenance or orchestrator threads outliving the test
+        self.patch(jobs, 'start', lambda: None)
+        self.patch(utils, 'launch_orchestrator_when_ready', lambda dn: None)
+
+    def patch(self, obj, name, value):
+        self.addCleanup(setattr, obj, name, getattr(obj, name))
+        setattr(obj, name, value)
+
+    def wait_for_job(self, location, timeout=5):
+        """Wait for the job at the given url to finish, return its document"""
+        id = location.rsplit('/', 1)[1]
+        jobs.wait(id, timeout)
+        return jobs.get(id)
+
+    def get(self, path, **headers):
+        headers.update(self.headers)
+        return self.client.get(self.API + path, headers=headers)
+
+    def post(self, path, data, **headers):
+        headers.update(self.headers)
+        return self.client.post(self.API + path, data=json.dumps(data),
+                                content_type='application/json',
+                                headers=headers)
+
+    def delete(self, path, **headers):
+        headers.update(self.headers)
+        return self.client.delete(self.API + path, headers=headers)
@@ -0,0 +1,61 @@
+"""Tests for the LRU cache"""
+import time
+import unittest
+
+from app.cache import LRUCache
+
+
+class LRUCacheTestCase(unittest.TestCase):
+
+    def test_get_and_set(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b', 'missing'), 'missing')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_expired_entries_are_not_returned(self):
+        cache = LRUCache()
+        cache.set('a', 1, expires=time.time() + 0.05)
+        time.sleep(0.1)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.expirations, 1)
+
+    def test_already_expired_entries_are_not_stored(self):
+        cache = LRUCache()
+        cache.set('a', 1, expires=time.time() - 1)
+        self.assertEqual(len(cache), 0)
+
+    def test_set_purges_expired_entries(self):
+        cache = LRUCache(maxsize=3)
+        cache.set('a', 1, expires=time.time() + 0.05)
+        cache.set('b', 2, expires=time.time() + 0.05)
+        cache.set('c', 3, expires=time.time() + 60)
+        time.sleep(0.1)
+        cache.set('d', 4)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.expirations, 2)
+        # The live entries kept their slots, nothing had to be evicted
+        self.assertEqual(cache.evictions, 0)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_info_reports_live_entries(self):
+        cache = LRUCache(ttl=0.05)
+        cache.set('a', 1)
+        time.sleep(0.1)
+        self.assertEqual(cache.info()['size'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+"""Tests for the product documents and the product index"""
+import json
+import unittest
+
+import registry
+
+from app import catalog, consul
+from app.catalog import product_index, CATALOG_INDEX_KEY
+from .fakeconsul import ApiTestCase, ConsulTestCase
+
+
+class ProductIndexTestCase(ConsulTestCase):
+
+    def setUp(self):
+        super(ProductIndexTestCase, self).setUp()
+        registry.register('cassandra', '3.0', 'Cassandra', logo_url='c.png')
+        registry.register('cassandra', '3.1', 'Cassandra')
+        registry.register('mongodb', '3.2', 'MongoDB')
+
+    def stored(self):
+        return json.loads(self.consul.get(CATALOG_INDEX_KEY))
+
+    def test_is_rebuilt_when_missing(self):
+        index = product_index.get()
+        self.assertEqual(sorted(index), ['cassandra', 'mongodb'])
+        self.assertEqual(index['cassandra']['3.0'],
+                         {'description': 'Cassandra', 'logo_url': 'c.png'})
+        self.assertEqual(self.stored(), index)
+        self.assertEqual(product_index.versions('cassandra'), ['3.0', '3.1'])
+
+    def test_add_and_remove(self):
+        product_index.get()
+        product_index.add('gluster', '3.8', description='Gluster', other='x')
+        self.assertEqual(self.stored()['gluster'], {'3.8': {'description': 'Gluster'}})
+        product_index.remove('cassandra', '3.0')
+        product_index.remove('mongodb', '3.2')
+        self.assertEqual(product_index.versions('cassandra'), ['3.1'])
+        self.assertNotIn('mongodb', self.stored())
+
+    def test_add_retries_when_the_index_changed(self):
+        product_index.get()
+        cas = consul.cas
+        calls = []
+
+        def concurrent_cas(key, value, index):
+            calls.append(index)
+            if len(calls) == 1:
+                # Another worker adds a product before this write
+                cas(key, json.dumps(dict(self.stored(), gluster={'3.8': {}})),
+                    index)
+            return cas(key, value, index)
+        consul.cas = concurrent_cas
+        self.addCleanup(setattr, consul, 'cas', cas)
+
+        product_index.add('hadoop', '2.7')
+        self.assertEqual(len(calls), 2)
+        self.assertIn('gluster', self.stored())
+        self.assertIn('hadoop', self.stored())
+
+    def test_rebuild_keeps_concurrent_changes(self):
+        product_index.get()
+        read = consul.read
+        registered = []
+
+        def concurrent_read(key, **kwargs):
+            result = read(key, **kwargs)
+            if key == registry.TMPLPREFIX + '/' and not registered:
+                # Registered by another worker after the registry was read
+                registered.append(True)
+                registry.register('gluster', '3.8', 'Gluster')
+                product_index.add('gluster', '3.8', description='Gluster')
+            return result
+        consul.read = concurrent_read
+        self.addCleanup(setattr, consul, 'read', read)
+
+        rebuilt = product_index.rebuild()
+        self.assertIn('gluster', rebuilt)
+        self.assertEqual(self.stored(), rebuilt)
+
+
+class ProductEndpointsTestCase(ApiTestCase):
+
+    def test_register_list_and_deregister(self):
+        rv = self.post('/products', {'name': 'cassandra', 'version': '3.0',
+                                     'description': 'Cassandra',
+                                     'logo_url': 'c.png'})
+        self.assertEqual(rv.status_code, 201)
+        self.assertEqual(json.loads(self.get('/products').data),
+                         {'products': ['cassandra']})
+        self.assertEqual(json.loads(self.get('/products/cassandra').data),
+                         {'versions': ['3.0']})
+        self.assertEqual(self.delete('/products/cassandra/3.0').status_code, 204)
+        self.assertEqual(json.loads(self.get('/products').data),
+                         {'products': []})
+        self.assertEqual(self.delete('/products/cassandra/3.0').status_code, 404)
+
+    def test_deregister_keeps_versions_sharing_its_prefix(self):
+        for version in ('3.0', '3.0.8'):
+            rv = self.post('/products', {'name': 'cassandra',
+                                         'version': version,
+                                         'description': 'Cassandra',
+                                         'logo_url': 'c.png'})
+            self.assertEqual(rv.status_code, 201)
+        self.assertEqual(self.delete('/products/cassandra/3.0').status_code, 204)
+        self.assertEqual(self.consul.keys('products/cassandra/3.0/'), [])
+        self.assertNotEqual(self.consul.keys('products/cassandra/3.0.8/'), [])
+        self.assertEqual(self.get('/products/cassandra/3.0.8').status_code, 200)
+        self.assertEqual(json.loads(self.get('/products/cassandra').data),
+                         {'versions': ['3.0.8']})
+        catalog.products._entries.clear()
+        self.assertEqual(json.loads(self.post('/catalog/rebuild', {}).data),
+                         {'products': 1, 'versions': 1})
+
+    def test_rebuild(self):
+        registry.register('cassandra', '3.0', 'Cassandra')
+        self.consul.put(CATALOG_INDEX_KEY, '{}')
+        self.assertEqual(json.loads(self.get('/products').data),
+                         {'products': []})
+        rv = self.post('/catalog/rebuild', {})
+        self.assertEqual(json.loads(rv.data), {'products': 1, 'versions': 1})
+        self.assertEqual(json.loads(self.get('/products').data),
+                         {'products': ['cassandra']})
+
+
+class ProductCacheTestCase(ConsulTestCase):
+
+    def test_reads_a_product_once(self):
+        registry.register('cassandra', '3.0', 'Cassandra')
+        product = catalog.products.get('cassandra', '3.0')
+        self.assertEqual(product.description, 'Cassandra')
+        self.assertEqual(product.to_dict()['name'], 'cassandra')
+        n = len(self.consul.requests)
+        self.assertIs(catalog.products.get('cassandra', '3.0'), product)
+        self.assertEqual(len(self.consul.requests), n)
+
+    def test_revalidates_expired_entries(self):
+        registry.register('cassandra', '3.0', 'Cassandra')
+        products = catalog.ProductCache(ttl=0)
+        product = products.get('cassandra', '3.0')
+        self.assertIs(products.get('cassandra', '3.0'), product)
+        self.consul.put('products/cassandra/3.0/description', 'New')
+        self.assertEqual(products.get('cassandra', '3.0').description, 'New')
+        self.assertEqual(products.revalidations, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
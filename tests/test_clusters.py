@@ -0,0 +1,140 @@
+"""Tests for the cluster endpoints"""
+import json
+import unittest
+
+from .fakeconsul import ApiTestCase
+
+PREFIX = 'clusters/test/cassandra/3.0'
+
+
+class ClusterTestCase(ApiTestCase):
+
+    def setUp(self):
+        super(ClusterTestCase, self).setUp()
+        dn = PREFIX + '/1'
+        self.consul.put(dn + '/status', 'running')
+        self.consul.put(dn + '/dnsname', '1')
+        self.consul.put(dn + '/nodes/', '')
+        for node in ('node0', 'node1'):
+            self.consul.put('{}/nodes/{}/mem'.format(dn, node), '1024')
+            self.consul.put('{}/nodes/{}/host'.format(dn, node), 'host0')
+            self.consul.put('{}/nodes/{}/disks/disk0/destination'.format(dn, node),
+                            '/data/0')
+            self.consul.put('{}/nodes/{}/networks/eth0/address'.format(dn, node),
+                            '10.0.0.1')
+            self.consul.put('{}/services/db/nodes/{}'.format(dn, node), '')
+        self.consul.put(dn + '/services/db/status', 'ready')
+
+    def test_get_cluster(self):
+        rv = self.get('/clusters/test/cassandra/3.0/1')
+        self.assertEqual(rv.status_code, 200)
+        data = json.loads(rv.data)['data']
+        self.assertEqual(data, {'name': '1', 'status': 'running',
+                                'dn': PREFIX + '/1'})
+
+    def test_get_cluster_fields(self):
+        rv = self.get('/clusters/test/cassandra/3.0/1?fields=status')
+        self.assertEqual(json.loads(rv.data)['data'], {'status': 'running'})
+
+    def test_get_cluster_unknown_field(self):
+        rv = self.get('/clusters/test/cassandra/3.0/1?fields=status,x')
+        self.assertEqual(rv.status_code, 400)
+
+    def test_get_missing_cluster(self):
+        for fields in ('', '?fields=dn', '?fields=status'):
+            rv = self.get('/clusters/test/cassandra/3.0/2' + fields)
+            self.assertEqual(rv.status_code, 404, fields)
+
+    def test_get_cluster_nodes(self):
+        rv = self.get('/clusters/test/cassandra/3.0/1/nodes')
+        nodes = json.loads(rv.data)['nodes']
+        self.assertEqual([n['name'] for n in nodes], ['node0', 'node1'])
+        self.assertEqual(nodes[0]['disks'], [{'name': 'disk0', 'host': 'host0'}])
+        self.assertEqual(nodes[0]['networks'],
+                         [{'name': 'eth0', 'address': '10.0.0.1'}])
+        self.assertEqual(nodes[0]['mem'], '1024')
+
+    def test_get_cluster_nodes_fields(self):
+        rv = self.get('/clusters/test/cassandra/3.0/1/nodes?fields=name,disks')
+        nodes = json.loads(rv.data)['nodes']
+        self.assertEqual(nodes[0], {'name': 'node0',
+                                    'disks': [{'name': 'disk0', 'host': 'host0'}]})
+
+    def test_get_cluster_services(self):
+        rv = self.get('/clusters/test/cassandra/3.0/1/services')
+        services = json.loads(rv.data)['services']
+        self.assertEqual([(s['name'], s['status']) for s in services],
+                         [('db', 'ready')])
+
+    def test_get_missing_cluster_nodes(self):
+        rv = self.get('/clusters/test/cassandra/3.0/2/nodes')
+        self.assertEqual(rv.status_code, 404)
+
+
+
+class ClusterListingTestCase(ApiTestCase):
+
+    def setUp(self):
+        super(ClusterListingTestCase, self).setUp()
+        for id in range(1, 6):
+            self.consul.put('{}/{}/status'.format(PREFIX, id),
+                            'running' if id % 2 else 'destroyed')
+            self.consul.put('{}/{}/dnsname'.format(PREFIX, id), str(id))
+            self.consul.put('{}/{}/nodes/node0/mem'.format(PREFIX, id), '1')
+        self.consul.put('clusters/test2/cassandra/3.0/1/status', 'running')
+        self.consul.put('clusters/test2/cassandra/3.0/1/dnsname', '1')
+
+    def clusters(self, path):
+        rv = self.get(path)
+        self.assertEqual(rv.status_code, 200)
+        data = json.loads(rv.data)
+        return [c['data']['dn'] for c in data['clusters']], data.get('next')
+
+    def test_lists_the_clusters_of_a_user(self):
+        (dns, next) = self.clusters('/clusters/test')
+        self.assertEqual(dns, ['{}/{}'.format(PREFIX, id) for id in range(1, 6)])
+        self.assertIsNone(next)
+
+    def test_pages_follow_the_cursor(self):
+        seen = []
+        path = '/clusters/test?limit=2'
+        while path:
+            (dns, next) = self.clusters(path)
+            self.assertLessEqual(len(dns), 2)
+            seen.extend(dns)
+            path = next and next.split(self.API, 1)[1]
+        self.assertEqual(seen, ['{}/{}'.format(PREFIX, id) for id in range(1, 6)])
+
+    def test_cursor_keeps_the_filters(self):
+        (dns, next) = self.clusters('/clusters/test?limit=1&status=running')
+        self.assertEqual(dns, [PREFIX + '/1'])
+        self.assertIn('status=running', next)
+        (dns, next) = self.clusters(next.split(self.API, 1)[1])
+        self.assertEqual(dns, [PREFIX + '/3'])
+
+    def test_last_page_has_no_next(self):
+        (dns, next) = self.clusters('/clusters/test?limit=5')
+        self.assertEqual(len(dns), 5)
+        self.assertIsNone(next)
+
+    def test_since(self):
+        index = self.consul.index
+        self.consul.put(PREFIX + '/4/status', 'running')
+        (dns, _) = self.clusters('/clusters/test?since={}'.format(index))
+        self.assertEqual(dns, [PREFIX + '/4'])
+
+    def test_invalid_limit_and_cursor(self):
+        self.assertEqual(self.get('/clusters/test?limit=0').status_code, 400)
+        self.assertEqual(self.get('/clusters/test?limit=100000').status_code, 400)
+        self.assertEqual(self.get('/clusters/test?cursor=a').status_code, 400)
+        for query in ('limit=abc', 'limit=', 'limit=1.5', 'since=abc'):
+            rv = self.get('/clusters/test?' + query)
+            self.assertEqual(rv.status_code, 400, query)
+
+    def test_user_prefix_does_not_match_other_users(self):
+        (dns, _) = self.clusters('/clusters/test2')
+        self.assertEqual(dns, ['clusters/test2/cassandra/3.0/1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+"""Tests for the compression of the API responses"""
+import json
+import unittest
+import zlib
+
+from app import compression, events
+from .fakeconsul import ApiTestCase
+
+PREFIX = 'clusters/test/cassandra/3.0'
+
+
+def decompress(data, encoding):
+    return zlib.decompress(data, dict(compression.ENCODINGS)[encoding])
+
+
+class CompressionTestCase(ApiTestCase):
+
+    def setUp(self):
+        super(CompressionTestCase, self).setUp()
+        self.register_product('cassandra', '3.0', 'cassandra')
+        compression.compressed_bodies.clear()
+        self.compressed = []
+        compress = compression.compress
+
+        def counted(data, encoding):
+            self.compressed.append(encoding)
+            return compress(data, encoding)
+        self.patch(compression, 'compress', counted)
+
+    def test_gzip(self):
+        plain = self.get('/products/cassandra/3.0/template')
+        self.assertGreaterEqual(len(plain.data), compression.COMPRESS_MIN_SIZE)
+        self.assertNotIn('Content-Encoding', plain.headers)
+        rv = self.get('/products/cassandra/3.0/template',
+                      **{'Accept-Encoding': 'gzip'})
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', rv.headers['Vary'])
+        self.assertEqual(int(rv.headers['Content-Length']), len(rv.data))
+        self.assertLess(len(rv.data), len(plain.data))
+        self.assertEqual(decompress(rv.data, 'gzip'), plain.data)
+
+    def test_deflate(self):
+        plain = self.get('/products/cassandra/3.0/template')
+        rv = self.get('/products/cassandra/3.0/template',
+                      **{'Accept-Encoding': 'deflate'})
+        self.assertEqual(rv.headers['Content-Encoding'], 'deflate')
+        self.assertEqual(decompress(rv.data, 'deflate'), plain.data)
+
+    def test_preferred_encoding(self):
+        rv = self.get('/products/cassandra/3.0/template',
+                      **{'Accept-Encoding': 'gzip;q=0.5, deflate'})
+        self.assertEqual(rv.headers['Content-Encoding'], 'deflate')
+        rv = self.get('/products/cassandra/3.0/template',
+                      **{'Accept-Encoding': 'br'})
+        self.assertNotIn('Content-Encoding', rv.headers)
+        self.assertIn('Accept-Encoding', rv.headers['Vary'])
+
+    def test_encodings_have_their_own_etag(self):
+        etags = set(self.get('/products/cassandra/3.0/template',
+                             **{'Accept-Encoding': e}).headers['ETag']
+                    for e in ('identity', 'gzip', 'deflate'))
+        self.assertEqual(len(etags), 3)
+
+    def test_small_responses_are_not_compressed(self):
+        rv = self.get('/products', **{'Accept-Encoding': 'gzip'})
+        self.assertLess(len(rv.data), compression.COMPRESS_MIN_SIZE)
+        self.assertNotIn('Content-Encoding', rv.headers)
+        self.assertIn('Accept-Encoding', rv.headers['Vary'])
+        self.assertEqual(json.loads(rv.data), {'products': ['cassandra']})
+
+    def test_compressed_bodies_are_reused(self):
+        for _ in range(2):
+            rv = self.get('/products/cassandra/3.0/template',
+                          **{'Accept-Encoding': 'gzip'})
+            self.assertEqual(rv.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(self.compressed, ['gzip'])
+        self.get('/products/cassandra/3.0/template',
+                 **{'Accept-Encoding': 'deflate'})
+        self.assertEqual(self.compressed, ['gzip', 'deflate'])
+        self.assertEqual(compression.compressed_bodies.info()['size'], 2)
+
+    def test_streamed_listing(self):
+        self.consul.put(PREFIX + '/1/status', 'running')
+        self.consul.put(PREFIX + '/1/dnsname', '1')
+        # Streamed bodies are read before the next request is made
+        plain = self.get('/clusters/test/cassandra/3.0').data
+        rv = self.get('/clusters/test/cassandra/3.0',
+                      **{'Accept-Encoding': 'gzip'})
+        data = rv.data
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', rv.headers)
+        # Compressed whatever their size, they are sent as they are built
+        self.assertLess(len(plain), compression.COMPRESS_MIN_SIZE)
+        self.assertEqual(decompress(data, 'gzip'), plain)
+        self.assertEqual(self.compressed, [])
+
+    def test_event_stream_is_not_compressed(self):
+        self.patch(events.queue, 'start', lambda: None)
+        rv = self.get('/clusters/test/events', **{'Accept-Encoding': 'gzip'})
+        self.addCleanup(rv.close)
+        self.assertEqual(rv.mimetype, 'text/event-stream')
+        self.assertNotIn('Content-Encoding', rv.headers)
+        self.assertEqual(next(rv.response), 'retry: 5000\n\n')
+
+    def test_other_methods_are_not_compressed(self):
+        rv = self.post('/catalog/rebuild', {}, **{'Accept-Encoding': 'gzip'})
+        self.assertEqual(rv.status_code, 200)
+        self.assertNotIn('Content-Encoding', rv.headers)
+        self.assertNotIn('Vary', rv.headers)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+"""Tests for the conditional GETs answered with 304 Not Modified"""
+import unittest
+
+from werkzeug.test import EnvironBuilder, run_wsgi_app
+
+from app import app, mirror
+from .fakeconsul import ApiTestCase
+
+CLUSTER = '/clusters/test/cassandra/3.0/1'
+DN = 'clusters/test/cassandra/3.0/1'
+
+
+class ConditionalTestCase(ApiTestCase):
+
+    def setUp(self):
+        super(ConditionalTestCase, self).setUp()
+        self.register_product('cassandra', '3.0', 'cassandra')
+        self.consul.put(DN + '/status', 'running')
+        self.consul.put(DN + '/dnsname', '1')
+
+    def requests(self, path, **headers):
+        """Response of GET path and the Consul requests it made"""
+        n = len(self.consul.requests)
+        rv = self.get(path, **headers)
+        return rv, self.consul.requests[n:]
+
+    def test_matching_etag_gets_304(self):
+        rv = self.get('/products/cassandra/3.0')
+        self.assertEqual(rv.status_code, 200)
+        etag = rv.headers['ETag']
+        rv = self.get('/products/cassandra/3.0', **{'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 304)
+        self.assertEqual(rv.data, '')
+        self.assertEqual(rv.headers['ETag'], etag)
+
+    def test_304_has_no_content_type(self):
+        etag = self.get('/products/cassandra/3.0').headers['ETag']
+        environ = EnvironBuilder(
+            '/bigdata/api/v1/products/cassandra/3.0',
+            headers=dict(self.headers, **{'If-None-Match': etag})).get_environ()
+        (_, status, headers) = run_wsgi_app(app, environ)
+        self.assertTrue(status.startswith('304'))
+        self.assertNotIn('Content-Type', headers)
+
+    def test_etag_changes_with_the_data(self):
+        etag = self.get(CLUSTER).headers['ETag']
+        self.consul.put(DN + '/status', 'destroyed')
+        rv = self.get(CLUSTER, **{'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 200)
+        self.assertNotEqual(rv.headers['ETag'], etag)
+
+    def test_etag_depends_on_the_query_and_the_encoding(self):
+        etag = self.get(CLUSTER).headers['ETag']
+        self.assertNotEqual(self.get(CLUSTER + '?fields=dn').headers['ETag'], etag)
+        gzip = self.get(CLUSTER, **{'Accept-Encoding': 'gzip'}).headers['ETag']
+        self.assertNotEqual(gzip, etag)
+
+    def test_without_the_mirror_the_view_reads_once(self):
+        (rv, reads) = self.requests(CLUSTER)
+        self.assertEqual(rv.status_code, 200)
+        # One read per attribute of the cluster, no extra read of the index
+        self.assertEqual(sorted(path for _, path, _ in reads),
+                         ['kv/{}/dnsname'.format(DN), 'kv/{}/status'.format(DN)])
+        (rv, reads) = self.requests(CLUSTER, **{'If-None-Match': rv.headers['ETag']})
+        self.assertEqual(rv.status_code, 304)
+        self.assertEqual(len(reads), 2)
+
+    def test_product_listing_reads_the_index_once(self):
+        self.get('/products')
+        (rv, reads) = self.requests('/products')
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual([path for _, path, _ in reads], ['kv/catalog/products'])
+        self.assertIn('ETag', rv.headers)
+
+    def test_with_the_mirror_the_view_does_not_run(self):
+        entries = [{'Key': k, 'Value': v['Value'], 'ModifyIndex': v['ModifyIndex']}
+                   for k, v in self.consul.store.items()
+                   if k.startswith(mirror.instances.prefix)]
+        state = (mirror.instances._state, mirror.instances._thread,
+                 mirror.instances.synced, mirror.instances.index)
+        self.addCleanup(self.restore_mirror, state)
+        # A watcher that already loaded the tree, without its thread
+        mirror.instances._thread = object()
+        mirror.instances._apply(entries, self.consul.index)
+        app.config['MIRROR_INSTANCES'] = True
+
+        (rv, reads) = self.requests(CLUSTER)
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(reads, [])
+        (rv, reads) = self.requests(CLUSTER, **{'If-None-Match': rv.headers['ETag']})
+        self.assertEqual(rv.status_code, 304)
+        self.assertEqual(reads, [])
+        self.assertIn('X-Registry-Staleness', rv.headers)
+
+    def restore_mirror(self, state):
+        (mirror.instances._state, mirror.instances._thread,
+         mirror.instances.synced, mirror.instances.index) = state
+
+
+if __name__ == '__main__':
+    unittest.main()
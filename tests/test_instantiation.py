@@ -0,0 +1,158 @@
+"""Tests for the registration of new clusters"""
+import json
+import time
+import unittest
+
+import kvstore
+import registry
+
+from app import consul, instantiation
+from .fakeconsul import ApiTestCase, ConsulTestCase
+
+DN = 'clusters/test/cassandra/3.0/1'
+# Options of a cluster that needs more than one transaction
+BIG = {'size': 8}
+
+
+class InstantiateTestCase(ConsulTestCase):
+
+    def setUp(self):
+        super(InstantiateTestCase, self).setUp()
+        self.register_product('cassandra', '3.0', 'cassandra')
+
+    def test_writes_the_rendered_cluster(self):
+        cluster = instantiation.instantiate('test', 'cassandra', '3.0',
+                                            {'size': 3})
+        self.assertEqual(cluster.dn, DN)
+        self.assertEqual(self.consul.get(DN + '/status'), 'registered')
+        self.assertEqual(self.consul.get(DN + '/nodes/cassandranode2/mem'),
+                         '10240')
+        self.assertIn(DN + '/services/seeds/nodes/cassandranode0',
+                      self.consul.store)
+
+    def test_writes_the_same_keys_as_the_registry(self):
+        instantiation.instantiate('test', 'cassandra', '3.0', {'size': 3})
+        ours = {k: v['Value'] for k, v in self.consul.store.items()
+                if k.startswith(DN + '/')}
+        self.consul.store.clear()
+        self.register_product('cassandra', '3.0', 'cassandra')
+        registry.instantiate('test', 'cassandra', '3.0', {'size': 3})
+        theirs = {k: v['Value'] for k, v in self.consul.store.items()
+                  if k.startswith(DN + '/')}
+        # registry.instantiate() leaves the status to the caller
+        theirs[DN + '/status'] = 'registered'
+        self.assertEqual(ours, theirs)
+
+    def test_big_clusters_need_several_transactions(self):
+        report = instantiation.dry_run('test', 'cassandra', '3.0', BIG)
+        self.assertGreater(report['keys'], consul.TXN_MAX_OPERATIONS)
+        self.assertGreater(report['transactions'], 1)
+
+    def test_status_is_written_in_the_last_transaction(self):
+        self.consul.fail_txn_after = 1
+        with self.assertRaises(kvstore.KVStoreError):
+            instantiation.instantiate('test', 'cassandra', '3.0', BIG)
+        self.assertNotIn(DN + '/status', self.consul.store)
+
+    def test_failed_registration_is_rolled_back(self):
+        self.consul.fail_txn_after = 1
+        with self.assertRaises(kvstore.KVStoreError):
+            instantiation.instantiate('test', 'cassandra', '3.0', BIG)
+        self.assertEqual(self.consul.keys('clusters/'), [])
+
+    def test_rollback_keeps_other_clusters(self):
+        self.consul.put('clusters/test/cassandra/3.0/10/status', 'running')
+        self.consul.fail_txn_after = 1
+        with self.assertRaises(kvstore.KVStoreError):
+            instantiation.instantiate('test', 'cassandra', '3.0', BIG)
+        self.assertEqual(self.consul.keys('clusters/'),
+                         ['clusters/test/cassandra/3.0/10/status'])
+
+
+class DryRunTestCase(ConsulTestCase):
+
+    def setUp(self):
+        super(DryRunTestCase, self).setUp()
+        self.register_product('cassandra', '3.0', 'cassandra')
+
+    def test_reports_the_keys_without_writing_them(self):
+        report = instantiation.dry_run('test', 'cassandra', '3.0', {'size': 3})
+        self.assertEqual(report['nodes'], 3)
+        self.assertFalse(report['cached'])
+        self.assertEqual(self.consul.keys('clusters/'), [])
+        instantiation.instantiate('test', 'cassandra', '3.0', {'size': 3})
+        self.assertEqual(len(self.consul.keys(DN + '/')), report['keys'])
+        transactions = [r for r in self.consul.requests if r[1] == 'txn']
+        self.assertEqual(len(transactions), report['transactions'])
+
+    def test_reports_are_memoized(self):
+        instantiation.dry_run('test', 'cassandra', '3.0', {'size': 3})
+        report = instantiation.dry_run('test', 'cassandra', '3.0', {'size': 3})
+        self.assertTrue(report['cached'])
+
+    def test_only_the_counts_are_memoized(self):
+        report = instantiation.dry_run('test', 'cassandra', '3.0', {'size': 3},
+                                       topology=True)
+        self.assertEqual(len(report['topology']['nodes']), 3)
+        [(_, memoized)] = instantiation.dry_runs._entries.items()
+        self.assertEqual(sorted(memoized[0]), [
+            'dn', 'keys', 'nodes', 'render_time', 'services', 'transactions'])
+        report = instantiation.dry_run('test', 'cassandra', '3.0', {'size': 3})
+        self.assertTrue(report['cached'])
+        self.assertNotIn('topology', report)
+        self.assertEqual(report['options']['size'], 3)
+        # The topology is rendered again when asked for
+        report = instantiation.dry_run('test', 'cassandra', '3.0', {'size': 3},
+                                       topology=True)
+        self.assertFalse(report['cached'])
+        self.assertIn('topology', report)
+
+    def test_render_iterations_are_bounded(self):
+        for size in (10 ** 6, 10 ** 30):
+            start = time.time()
+            with self.assertRaises(registry.InvalidOptionsError):
+                instantiation.dry_run('test', 'cassandra', '3.0', {'size': size})
+            self.assertLess(time.time() - start, 1)
+        # Nested loops count every iteration: size * disks
+        with self.assertRaises(registry.InvalidOptionsError):
+            instantiation.dry_run('test', 'cassandra', '3.0',
+                                  {'size': 1000, 'disks': 1000})
+        self.assertEqual(len(instantiation.dry_runs._entries), 0)
+
+    def test_cluster_keys_are_bounded(self):
+        report = instantiation.dry_run('test', 'cassandra', '3.0', {'size': 3})
+        keys = instantiation.CLUSTER_MAX_KEYS
+        self.addCleanup(setattr, instantiation, 'CLUSTER_MAX_KEYS', keys)
+        instantiation.CLUSTER_MAX_KEYS = report['keys'] - 1
+        with self.assertRaises(registry.InvalidOptionsError):
+            instantiation.dry_run('test', 'cassandra', '3.0', {'size': 3},
+                                  topology=True)
+        with self.assertRaises(registry.InvalidOptionsError):
+            instantiation.instantiate('test', 'cassandra', '3.0', {'size': 3})
+        self.assertEqual(self.consul.keys('clusters/'), [])
+
+
+class RenderEndpointTestCase(ApiTestCase):
+
+    def setUp(self):
+        super(RenderEndpointTestCase, self).setUp()
+        self.register_product('cassandra', '3.0', 'cassandra')
+
+    def test_render(self):
+        rv = self.post('/products/cassandra/3.0/render', {'size': 3})
+        self.assertEqual(rv.status_code, 200)
+        report = json.loads(rv.data)
+        self.assertEqual(report['nodes'], 3)
+        self.assertNotIn('topology', report)
+        rv = self.post('/products/cassandra/3.0/render?topology=true',
+                       {'size': 3})
+        self.assertEqual(len(json.loads(rv.data)['topology']['nodes']), 3)
+
+    def test_render_too_big(self):
+        rv = self.post('/products/cassandra/3.0/render', {'size': 10 ** 6})
+        self.assertEqual(rv.status_code, 400)
+        self.assertIn('iterations', json.loads(rv.data)['message'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,332 @@
+"""Tests for the asynchronous requests stored as jobs in the KV store"""
+import json
+import threading
+import time
+import unittest
+
+from app import events, jobs, mirror
+from .fakeconsul import ApiTestCase, token
+
+DN = 'clusters/test/cassandra/3.0/1'
+
+
+class JobTestCase(ApiTestCase):
+
+    def setUp(self):
+        super(JobTestCase, self).setUp()
+        self.register_product('cassandra', '3.0', 'cassandra')
+
+    def launch(self, options=None):
+        rv = self.post('/products/cassandra/3.0', options or {'size': 3})
+        self.assertEqual(rv.status_code, 202)
+        return rv.headers['Location']
+
+    def job_id(self, location):
+        return location.rsplit('/', 1)[1]
+
+    def document(self, id):
+        return json.loads(self.consul.get(jobs.job_key(id)))
+
+    def payload(self, id):
+        return json.loads(self.consul.get(jobs.payload_key(id)))
+
+    def pending_job(self, id, **payload):
+        """Store a pending job as if its process had stopped before running it"""
+        payload = dict({
+            'handler': 'launch_cluster',
+            'view_args': {'product': 'cassandra', 'version': '3.0'},
+            'method': 'POST', 'path': '/bigdata/api/v1/products/cassandra/3.0',
+            'query_string': '', 'base_url': 'http://localhost/',
+            'headers': {'Content-Type': 'application/json'},
+            'data': json.dumps({'size': 3}), 'user': 'test',
+            'role': 'ROLE_USER'}, **payload)
+        self.consul.put(jobs.payload_key(id), json.dumps(payload))
+        self.consul.put(jobs.job_key(id), json.dumps(
+            {'status': 'pending', 'created': time.time()}))
+
+
+class JobLifecycleTestCase(JobTestCase):
+
+    def test_launch_runs_as_a_job(self):
+        location = self.launch()
+        job = self.wait_for_job(location)
+        self.assertEqual(job['status'], 'registered')
+        self.assertEqual(job['status_code'], 201)
+        self.assertEqual(job['user'], 'test')
+        self.assertEqual(job['attempts'], 1)
+        self.assertTrue(job['url'].endswith('/clusters/test/cassandra/3.0/1'))
+        self.assertEqual(self.consul.get(DN + '/status'), 'registered')
+
+    def test_status_of_a_finished_job(self):
+        location = self.launch()
+        job = self.wait_for_job(location)
+        rv = self.client.get(location, headers=self.headers)
+        self.assertEqual(rv.status_code, 303)
+        self.assertEqual(rv.headers['Location'], job['url'])
+        self.assertEqual(json.loads(rv.data), {'status': 'registered',
+                                               'url': job['url']})
+
+    def test_status_of_a_pending_job(self):
+        self.pending_job('a' * 32)
+        rv = self.get('/queue/' + 'a' * 32)
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(json.loads(rv.data), {'status': 'pending'})
+
+    def test_status_of_a_failed_job(self):
+        self.consul.put(jobs.job_key('a' * 32), json.dumps(
+            {'status': 'error', 'status_code': 500, 'url': ''}))
+        rv = self.get('/queue/' + 'a' * 32)
+        self.assertEqual(json.loads(rv.data), {'status': 'error',
+                                               'status_code': 500})
+
+    def test_unknown_job(self):
+        self.assertEqual(self.get('/queue/' + 'b' * 32).status_code, 404)
+
+    def test_job_is_one_document_and_a_lock(self):
+        id = self.job_id(self.launch())
+        self.wait_for_job(jobs.job_key(id))
+        self.assertEqual(self.consul.keys(jobs.job_key(id)),
+                         [jobs.job_key(id), jobs.lock_key(id)])
+
+    def test_delete_finished_job(self):
+        id = self.job_id(self.launch())
+        self.wait_for_job('/queue/' + id)
+        self.assertEqual(self.delete('/queue/' + id).status_code, 204)
+        self.assertEqual(self.consul.keys(jobs.job_key(id)), [])
+        self.assertEqual(self.consul.keys(jobs.payload_key(id)), [])
+        self.assertEqual(self.get('/queue/' + id).status_code, 404)
+
+    def test_delete_pending_job(self):
+        self.pending_job('a' * 32)
+        self.assertEqual(self.delete('/queue/' + 'a' * 32).status_code, 409)
+        self.assertIn(jobs.job_key('a' * 32), self.consul.store)
+
+    def test_status_of_several_jobs(self):
+        id = self.job_id(self.launch())
+        job = self.wait_for_job('/queue/' + id)
+        self.pending_job('a' * 32)
+        rv = self.client.post(self.API + '/queue/status', headers=self.headers,
+                              data=json.dumps([id, 'a' * 32, 'b' * 32]),
+                              content_type='application/json')
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(json.loads(rv.data)['jobs'], {
+            id: {'status': 'registered', 'url': job['url'],
+                 'status_code': 201},
+            'a' * 32: {'status': 'pending'},
+            'b' * 32: None})
+
+    def test_status_of_too_many_jobs(self):
+        rv = self.client.post(self.API + '/queue/status', headers=self.headers,
+                              data=json.dumps(['a'] * 1001),
+                              content_type='application/json')
+        self.assertEqual(rv.status_code, 400)
+
+
+class JobMaintenanceTestCase(JobTestCase):
+
+    def finished_job(self, id, finished):
+        self.consul.put(jobs.job_key(id), json.dumps(
+            {'status': 'registered', 'status_code': 201, 'url': '',
+             'finished': finished}))
+        self.consul.put(jobs.payload_key(id), '{}')
+
+    def queue_reads(self):
+        return [r for r in self.consul.requests
+                if r[0] == 'GET' and r[1] == 'kv/' + jobs.QUEUE_PREFIX + '/']
+
+    def test_sweep(self):
+        now = time.time()
+        self.finished_job('a' * 32, now - jobs.JOBS_TTL - 1)
+        self.finished_job('b' * 32, now)
+        self.pending_job('c' * 32)
+        self.assertEqual(jobs.sweep(now=now), 1)
+        self.assertEqual(self.consul.keys(jobs.QUEUE_PREFIX + '/'),
+                         [jobs.job_key('b' * 32), jobs.job_key('c' * 32)])
+        self.assertEqual(self.consul.keys(jobs.PAYLOADS_PREFIX + '/'),
+                         [jobs.payload_key('b' * 32), jobs.payload_key('c' * 32)])
+
+    def test_sweep_dates_old_records(self):
+        self.consul.put(jobs.job_key('a' * 32) + '/status', 'registered')
+        self.assertEqual(jobs.sweep(now=1000), 0)
+        self.assertEqual(jobs.get('a' * 32)['finished'], 1000)
+        self.assertEqual(jobs.sweep(now=1001 + jobs.JOBS_TTL), 1)
+        self.assertEqual(self.consul.keys(jobs.QUEUE_PREFIX + '/'), [])
+
+    def test_scan_skips_the_payloads(self):
+        id = self.job_id(self.launch())
+        self.wait_for_job('/queue/' + id)
+        self.assertNotIn('payload', jobs.scan()[id]['job'])
+
+    def test_maintain(self):
+        self.finished_job('a' * 32, time.time() - jobs.JOBS_TTL - 1)
+        self.pending_job('b' * 32)
+        self.assertEqual(jobs.maintain(), (1, 1))
+        self.assertEqual(self.wait_for_job('/queue/' + 'b' * 32)['status'],
+                         'registered')
+        self.assertEqual(self.consul.store[jobs.MAINTENANCE_LOCK]['Session'],
+                         jobs.sessions.id)
+
+    def test_maintain_in_one_process_only(self):
+        self.assertIsNotNone(jobs.maintain())
+        # Another process, with a session of its own
+        jobs.sessions.id = None
+        self.pending_job('a' * 32)
+        del self.consul.requests[:]
+        self.assertIsNone(jobs.maintain())
+        self.assertEqual(self.queue_reads(), [])
+        self.assertEqual(self.document('a' * 32)['status'], 'pending')
+
+    def test_maintenance_moves_when_the_session_expires(self):
+        self.assertIsNotNone(jobs.maintain())
+        self.consul.sessions.clear()
+        self.consul.store[jobs.MAINTENANCE_LOCK]['Session'] = None
+        jobs.sessions.id = None
+        self.assertIsNotNone(jobs.maintain())
+
+
+class JobWaitTestCase(JobTestCase):
+
+    def test_job_finishes_during_the_wait(self):
+        self.pending_job('a' * 32)
+        url = 'http://localhost/bigdata/api/v1/clusters/test/cassandra/3.0/1'
+        finish = threading.Timer(0.2, jobs.finish,
+                                 ('a' * 32, 'registered', 201, url))
+        finish.start()
+        self.addCleanup(finish.cancel)
+        start = time.time()
+        rv = self.get('/queue/' + 'a' * 32 + '?wait=5s')
+        self.assertLess(time.time() - start, 4)
+        self.assertEqual(rv.status_code, 303)
+        self.assertEqual(rv.headers['Location'], url)
+
+    def test_wait_times_out(self):
+        self.pending_job('a' * 32)
+        start = time.time()
+        rv = self.get('/queue/' + 'a' * 32 + '?wait=300ms')
+        self.assertGreaterEqual(time.time() - start, 0.3)
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(json.loads(rv.data), {'status': 'pending'})
+
+    def test_finished_job_does_not_wait(self):
+        self.consul.put(jobs.job_key('a' * 32), json.dumps(
+            {'status': 'error', 'status_code': 500, 'url': ''}))
+        start = time.time()
+        rv = self.get('/queue/' + 'a' * 32 + '?wait=5s')
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(rv.status_code, 200)
+
+    def test_invalid_wait(self):
+        self.pending_job('a' * 32)
+        for wait in ('abc', '5', 'xs'):
+            rv = self.get('/queue/' + 'a' * 32 + '?wait=' + wait)
+            self.assertEqual(rv.status_code, 400, wait)
+
+    def test_wait_for_unknown_job(self):
+        rv = self.get('/queue/' + 'b' * 32 + '?wait=1s')
+        self.assertEqual(rv.status_code, 404)
+
+
+class JobCredentialsTestCase(JobTestCase):
+
+    def test_token_is_not_stored(self):
+        id = self.job_id(self.launch())
+        self.wait_for_job('/queue/' + id)
+        stored = self.consul.get(jobs.job_key(id))
+        self.assertNotIn(self.headers['X-Auth-Token'], stored)
+        self.assertNotIn('payload', self.document(id))
+        payload = self.payload(id)
+        self.assertEqual(payload['headers'], {'Content-Type': 'application/json'})
+        self.assertEqual((payload['user'], payload['role']), ('test', 'ROLE_USER'))
+
+    def test_recovered_job_runs_as_its_user(self):
+        self.pending_job('a' * 32, user='other')
+        self.assertEqual(jobs.recover(), 1)
+        job = self.wait_for_job('/queue/' + 'a' * 32)
+        self.assertEqual(job['status'], 'registered')
+        self.assertEqual(job['user'], 'other')
+        self.assertIn('clusters/other/cassandra/3.0/1/status', self.consul.store)
+
+    def test_job_runs_after_the_token_expired(self):
+        self.headers = {'X-Auth-Token': token(expires=time.time() + 1)}
+        id = self.job_id(self.launch())
+        self.wait_for_job('/queue/' + id)
+        self.consul.put(jobs.job_key('a' * 32), json.dumps(
+            {'status': 'pending', 'created': time.time()}))
+        self.consul.put(jobs.payload_key('a' * 32),
+                        self.consul.get(jobs.payload_key(id)))
+        time.sleep(1)
+        jobs.recover()
+        job = self.wait_for_job('/queue/' + 'a' * 32)
+        self.assertEqual(job['status'], 'registered')
+
+    def test_pending_job_of_the_baseline_layout_fails(self):
+        # One key per field and no payload, the request cannot be run again
+        self.consul.put(jobs.job_key('a' * 32) + '/status', 'pending')
+        jobs.recover()
+        job = self.wait_for_job('/queue/' + 'a' * 32)
+        self.assertEqual((job['status'], job['status_code']), ('error', 500))
+        self.assertEqual(self.consul.keys('clusters/'), [])
+
+    def test_interrupted_job_fails(self):
+        self.pending_job('a' * 32)
+        document = self.document('a' * 32)
+        document['attempts'] = 1
+        self.consul.put(jobs.job_key('a' * 32), json.dumps(document))
+        jobs.recover()
+        job = self.wait_for_job('/queue/' + 'a' * 32)
+        self.assertEqual((job['status'], job['status_code']), ('error', 500))
+        self.assertEqual(self.consul.keys('clusters/'), [])
+
+
+class JobEventsTestCase(JobTestCase):
+
+    def setUp(self):
+        super(JobEventsTestCase, self).setUp()
+        self.subscriber = events.bus.subscribe('test')
+        self.addCleanup(events.bus.unsubscribe, self.subscriber)
+
+    def published(self, id):
+        """Publish the job as the queue mirror would, return the events"""
+        entries, _ = jobs.consul.read(jobs.job_key(id))
+        events._job_changes(entries, [])
+        published = []
+        while not self.subscriber.queue.empty():
+            published.append(self.subscriber.queue.get_nowait())
+        return published
+
+    def test_finished_job_is_published(self):
+        id = self.job_id(self.launch())
+        job = self.wait_for_job('/queue/' + id)
+        [(event, data, _)] = self.published(id)
+        self.assertEqual(event, 'job')
+        self.assertEqual(data, {'id': id, 'status': 'registered',
+                                'url': job['url'], 'status_code': 201})
+
+    def test_interrupted_job_is_published(self):
+        self.pending_job('a' * 32)
+        jobs.update('a' * 32, lambda job: job.update(attempts=1))
+        jobs.run('a' * 32)
+        [(event, data, _)] = self.published('a' * 32)
+        self.assertEqual(data, {'id': 'a' * 32, 'status': 'error', 'url': '',
+                                'status_code': 500})
+
+    def test_failed_job_is_published(self):
+        def fail(product, version):
+            raise RuntimeError('failed')
+        self.patch(jobs, 'handlers', {'launch_cluster': fail})
+        self.pending_job('a' * 32)
+        jobs.run('a' * 32)
+        self.assertEqual(jobs.get('a' * 32)['user'], 'test')
+        [(event, data, _)] = self.published('a' * 32)
+        self.assertEqual(data['status_code'], 500)
+
+    def test_stream_without_the_instances_mirror(self):
+        started = []
+        self.patch(mirror.instances, 'start', lambda: started.append('instances'))
+        self.patch(events.queue, 'start', lambda: started.append('queue'))
+        events.stream('test')
+        self.assertEqual(started, ['queue'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+"""Tests for the options of a launch and the launch endpoint"""
+import json
+import unittest
+
+import registry
+
+from app.catalog import OptionsSchema
+from .fakeconsul import ApiTestCase
+
+OPTIONS = json.dumps({
+    'required': {'size': 3},
+    'optional': {'disks': 4},
+    'advanced': {'mem': 10240, 'heap': '4G', 'tags': ['a']},
+    'descriptions': {'size': 'Number of nodes'}})
+
+
+class OptionsSchemaTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.schema = OptionsSchema(OPTIONS)
+
+    def test_compiles_the_document(self):
+        self.assertEqual(self.schema.required, ['size'])
+        self.assertEqual(self.schema.defaults, {'size': 3, 'disks': 4,
+                                                'mem': 10240, 'heap': '4G',
+                                                'tags': ['a']})
+        self.assertEqual(self.schema.types, {'size': 'number', 'disks': 'number',
+                                             'mem': 'number', 'heap': 'string',
+                                             'tags': None})
+
+    def test_merge_completes_the_defaults(self):
+        merged = self.schema.merge({'size': 5, 'heap': '8G', 'other': 'x'})
+        self.assertEqual(merged, {'size': 5, 'disks': 4, 'mem': 10240,
+                                  'heap': '8G', 'tags': ['a'], 'other': 'x'})
+
+    def test_missing_required_options(self):
+        with self.assertRaises(registry.InvalidOptionsError) as e:
+            self.schema.validate({'disks': 2})
+        self.assertEqual(e.exception.message, 'missing required options: size')
+
+    def test_options_must_be_an_object(self):
+        for options in (None, [], 'size'):
+            with self.assertRaises(registry.InvalidOptionsError):
+                self.schema.validate(options)
+
+    def test_numeric_strings_are_numbers(self):
+        merged = self.schema.merge({'size': '2', 'mem': '10240', 'disks': '1.5'})
+        self.assertEqual((merged['size'], merged['mem'], merged['disks']),
+                         (2, 10240, 1.5))
+
+    def test_numbers_are_valid_text(self):
+        self.assertEqual(self.schema.merge({'size': 1, 'heap': 4})['heap'], 4)
+
+    def test_invalid_types(self):
+        for options in ({'size': 'three'}, {'size': [3]}, {'size': True},
+                        {'size': 3, 'heap': {'x': 1}}, {'size': None}):
+            with self.assertRaises(registry.InvalidOptionsError):
+                self.schema.validate(options)
+
+    def test_untyped_options_accept_anything(self):
+        self.assertEqual(self.schema.merge({'size': 1, 'tags': 'b'})['tags'], 'b')
+
+
+class LaunchTestCase(ApiTestCase):
+
+    def setUp(self):
+        super(LaunchTestCase, self).setUp()
+        self.register_product('cassandra', '3.0', 'cassandra')
+
+    def launch(self, options, **headers):
+        return self.post('/products/cassandra/3.0', options, **headers)
+
+    def test_launch(self):
+        rv = self.launch({'size': 3})
+        self.assertEqual(rv.status_code, 202)
+        job = self.wait_for_job(rv.headers['Location'])
+        self.assertEqual(job['status'], 'registered')
+        dn = 'clusters/test/cassandra/3.0/1'
+        self.assertEqual(self.consul.get(dn + '/status'), 'registered')
+        self.assertEqual(len(self.consul.keys(dn + '/nodes/cassandranode2/')), 12)
+
+    def test_numeric_strings_are_accepted(self):
+        rv = self.launch({'size': '2', 'mem': '10240'})
+        self.assertEqual(rv.status_code, 202)
+        job = self.wait_for_job(rv.headers['Location'])
+        self.assertEqual(job['status'], 'registered')
+        self.assertEqual(self.consul.get(
+            'clusters/test/cassandra/3.0/1/nodes/cassandranode1/mem'), '10240')
+
+    def test_invalid_options_are_rejected_before_the_job(self):
+        for options in ({}, {'size': 'three'}, ['size']):
+            rv = self.launch(options)
+            self.assertEqual(rv.status_code, 400)
+        self.assertEqual(self.consul.keys('queue/'), [])
+        self.assertEqual(self.consul.keys('clusters/'), [])
+
+    def test_unknown_product(self):
+        rv = self.post('/products/cassandra/4.0', {'size': 3})
+        self.assertEqual(rv.status_code, 404)
+
+    def test_authentication_goes_first(self):
+        self.headers = {}
+        n = len(self.consul.requests)
+        for product in ('cassandra/3.0', 'cassandra/4.0'):
+            for options in ({'size': 3}, {}):
+                rv = self.post('/products/' + product, options)
+                self.assertEqual(rv.status_code, 401)
+        self.assertEqual(self.consul.requests[n:], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
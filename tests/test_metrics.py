@@ -0,0 +1,29 @@
+"""Tests for the usage metrics of the API process"""
+import json
+import unittest
+
+from .fakeconsul import ApiTestCase
+
+
+class MetricsTestCase(ApiTestCase):
+
+    def test_metrics(self):
+        rv = self.get('/metrics')
+        self.assertEqual(rv.status_code, 200)
+        metrics = json.loads(rv.data)
+        self.assertEqual(sorted(metrics), [
+            'compressed_bodies', 'dry_runs', 'events', 'mirrors', 'outbound',
+            'products', 'templates', 'tokens', 'workers'])
+        self.assertIn('compilations', metrics['templates'])
+        self.assertIn('queue_depth', metrics['workers'])
+        self.assertEqual(sorted(metrics['mirrors']), ['instances', 'queue'])
+        # The request itself was authenticated through the token cache
+        self.assertGreaterEqual(metrics['tokens']['size'], 1)
+
+    def test_metrics_need_authentication(self):
+        self.headers = {}
+        self.assertEqual(self.get('/metrics').status_code, 401)
+
+
+if __name__ == '__main__':
+    unittest.main()
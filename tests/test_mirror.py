@@ -0,0 +1,178 @@
+"""Tests for the in-memory mirrors of registry subtrees"""
+import json
+import time
+import unittest
+
+from app import app, consul, mirror
+from .fakeconsul import ApiTestCase
+
+DN = 'clusters/test/cassandra/3.0/1'
+
+
+def entry(key, value, index):
+    return {'Key': key, 'Value': value, 'ModifyIndex': index,
+            'CreateIndex': index, 'Flags': 0, 'LockIndex': 0}
+
+
+class Stop(BaseException):
+    """Ends the watcher loop, which carries on after any Exception"""
+
+
+class MirrorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.mirror = mirror.Mirror('test/', wait='1s', max_staleness=10)
+        self.changes = []
+        self.mirror.subscribe(
+            lambda changed, removed: self.changes.append(
+                (sorted(e['Key'] for e in changed), sorted(removed))))
+
+    def test_initial_load(self):
+        self.assertIsNone(self.mirror.staleness())
+        self.assertFalse(self.mirror.fresh())
+        self.mirror._apply([entry('test/b', '2', 3), entry('test/a', '1', 2)], 3)
+        self.assertEqual([e['Key'] for e in self.mirror.entries()],
+                         ['test/a', 'test/b'])
+        self.assertEqual(self.mirror.index, 3)
+        self.assertTrue(self.mirror.fresh())
+        # Listeners only get the changes after the initial load
+        self.assertEqual(self.changes, [])
+
+    def test_changes_are_diffed(self):
+        self.mirror._apply([entry('test/a', '1', 2), entry('test/b', '2', 3)], 3)
+        self.mirror._apply([entry('test/a', '1', 2), entry('test/b', '3', 5),
+                            entry('test/c', '4', 6)], 6)
+        self.assertEqual(self.changes, [(['test/b', 'test/c'], [])])
+        self.mirror._apply([entry('test/c', '4', 6)], 7)
+        self.assertEqual(self.changes[-1], ([], ['test/a', 'test/b']))
+        self.assertEqual([(e['Key'], e['Value']) for e in self.mirror.entries()],
+                         [('test/c', '4')])
+        self.assertEqual(self.mirror.updates, 3)
+
+    def test_unchanged_answer_only_confirms_the_copy(self):
+        entries = [entry('test/a', '1', 2)]
+        self.mirror._apply(entries, 2)
+        state = self.mirror._state
+        self.mirror.synced -= 5
+        self.mirror._apply(entries, 2)
+        self.assertIs(self.mirror._state, state)
+        self.assertLess(self.mirror.staleness(), 1)
+        self.assertEqual((self.mirror.updates, self.changes), (1, []))
+
+    def test_failing_listener(self):
+        def fail(changed, removed):
+            raise ValueError('failed')
+        self.mirror._listeners.insert(0, fail)
+        self.mirror._apply([], 1)
+        self.mirror._apply([entry('test/a', '1', 2)], 2)
+        self.assertEqual(self.changes, [(['test/a'], [])])
+
+    def test_entries_below_a_prefix(self):
+        self.mirror._apply([entry('test/a/1', '', 2), entry('test/a/2', '', 3),
+                            entry('test/ab', '', 4), entry('test/b', '', 5)], 5)
+        self.assertEqual([e['Key'] for e in self.mirror.entries('test/a/')],
+                         ['test/a/1', 'test/a/2'])
+        self.assertEqual([e['Key'] for e in self.mirror.entries('test/a/',
+                                                                'test/a/2')],
+                         ['test/a/2'])
+
+    def test_staleness(self):
+        self.mirror._apply([], 1)
+        self.mirror.synced = time.time() - 5
+        self.assertAlmostEqual(self.mirror.staleness(), 5, places=1)
+        self.assertTrue(self.mirror.fresh())
+        self.mirror.synced = time.time() - 11
+        self.assertFalse(self.mirror.fresh())
+
+    def watch(self, answers):
+        """Run the watcher on the given answers, return the indexes it asked"""
+        asked = []
+
+        def read(prefix, recurse, index, wait):
+            asked.append(index)
+            if not answers:
+                raise Stop()
+            answer = answers.pop(0)
+            if isinstance(answer, Exception):
+                raise answer
+            return answer
+        read_, sleep = consul.read, time.sleep
+        consul.read, time.sleep = read, lambda seconds: None
+        try:
+            self.mirror._watch()
+        except Stop:
+            pass
+        finally:
+            consul.read, time.sleep = read_, sleep
+        return asked
+
+    def test_watch_follows_the_index(self):
+        asked = self.watch([([entry('test/a', '1', 2)], 5),
+                            ([entry('test/a', '2', 7)], 7)])
+        self.assertEqual(asked, [None, 5, 7])
+        self.assertEqual(self.changes, [(['test/a'], [])])
+
+    def test_watch_starts_again_when_the_index_goes_backwards(self):
+        asked = self.watch([([entry('test/a', '1', 9)], 9),
+                            ([entry('test/a', '1', 2)], 3),
+                            ([entry('test/a', '1', 2)], 4)])
+        # After a Consul reset the next read is not a blocking one
+        self.assertEqual(asked, [None, 9, None, 4])
+        self.assertEqual(self.mirror.index, 4)
+
+    def test_watch_survives_errors(self):
+        asked = self.watch([([], 2), ValueError('unavailable'), ([], 3)])
+        self.assertEqual(asked, [None, 2, 2, 3])
+        self.assertEqual(self.mirror.errors, 1)
+
+
+class InstancesMirrorTestCase(ApiTestCase):
+    """Cluster reads from the instances mirror and back to Consul"""
+
+    def setUp(self):
+        super(InstancesMirrorTestCase, self).setUp()
+        self.consul.put(DN + '/status', 'running')
+        self.consul.put(DN + '/dnsname', '1')
+        instances = mirror.instances
+        state = (instances._state, instances._thread, instances.synced,
+                 instances.index)
+        self.addCleanup(self.restore, state)
+        # A watcher that already loaded the tree, without its thread
+        instances._thread = object()
+        entries, index = consul.read(instances.prefix, recurse=True)
+        instances._apply(entries, index)
+        app.config['MIRROR_INSTANCES'] = True
+
+    def restore(self, state):
+        (mirror.instances._state, mirror.instances._thread,
+         mirror.instances.synced, mirror.instances.index) = state
+
+    def reads(self, path):
+        del self.consul.requests[:]
+        rv = self.get(path)
+        return rv, [p for (_, p, _) in self.consul.requests]
+
+    def test_fresh_mirror_answers(self):
+        (rv, reads) = self.reads('/clusters/test/cassandra/3.0/1')
+        self.assertEqual(json.loads(rv.data)['data']['status'], 'running')
+        self.assertEqual(reads, [])
+        self.assertIn('X-Registry-Staleness', rv.headers)
+
+    def test_stale_mirror_falls_back_to_consul(self):
+        self.consul.put(DN + '/status', 'failed')
+        mirror.instances.synced = (time.time() -
+                                   mirror.instances.max_staleness - 1)
+        (rv, reads) = self.reads('/clusters/test/cassandra/3.0/1')
+        self.assertEqual(json.loads(rv.data)['data']['status'], 'failed')
+        self.assertNotEqual(reads, [])
+        self.assertNotIn('X-Registry-Staleness', rv.headers)
+
+    def test_disabled_mirror_is_not_used(self):
+        app.config['MIRROR_INSTANCES'] = False
+        (rv, reads) = self.reads('/clusters/test/cassandra/3.0/1')
+        self.assertEqual(rv.status_code, 200)
+        self.assertNotEqual(reads, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+"""Tests for the pooled sessions of the outbound HTTP calls"""
+import threading
+import unittest
+
+import requests
+
+from app.outbound import SessionPool
+
+URL = 'http://consul:8500/v1/kv/key'
+
+
+class Session(object):
+    """requests.Session answering without going to the network"""
+
+    def __init__(self, error=None):
+        self.error = error
+        self.adapters = {}
+
+    def request(self, method, url, **kwargs):
+        if self.error:
+            raise self.error
+        return kwargs
+
+
+class SessionPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = SessionPool(pool_size=4, timeout=3)
+        self.session = Session()
+        self.pool.session(URL)
+        self.pool._sessions['http://consul:8500'] = self.session
+
+    def test_default_timeout(self):
+        self.assertEqual(self.pool.get(URL), {'timeout': 3})
+        self.assertEqual(self.pool.get(URL, timeout=1), {'timeout': 1})
+
+    def test_counts_requests_and_errors(self):
+        self.pool.get(URL)
+        self.session.error = requests.ConnectionError('refused')
+        with self.assertRaises(requests.ConnectionError):
+            self.pool.put(URL)
+        info = self.pool.info()['http://consul:8500']
+        self.assertEqual((info['requests'], info['errors']), (2, 1))
+        self.assertEqual(info['pool_size'], 4)
+
+    def test_counters_are_not_lost_between_threads(self):
+        self.session.error = requests.Timeout('timeout')
+
+        def send():
+            for _ in range(1000):
+                try:
+                    self.pool.get(URL)
+                except requests.Timeout:
+                    pass
+        threads = [threading.Thread(target=send) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        info = self.pool.info()['http://consul:8500']
+        self.assertEqual((info['requests'], info['errors']), (8000, 8000))
+
+    def test_one_session_per_host(self):
+        other = self.pool.session('http://mesos:8080/v1/clusters')
+        self.assertIs(self.pool.session('http://mesos:8080/'), other)
+        self.assertEqual(sorted(self.pool.info()),
+                         ['http://consul:8500', 'http://mesos:8080'])
+
+
+if __name__ == '__main__':
+    unittest.main()
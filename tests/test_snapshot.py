@@ -0,0 +1,129 @@
+"""Tests for the registry reads of app.snapshot"""
+import unittest
+
+import kvstore
+import registry
+
+from app import snapshot
+from .fakeconsul import ConsulTestCase
+
+DN = 'clusters/test/cassandra/3.0/1'
+
+
+def entries(keys, index=1):
+    return [{'Key': k, 'Value': v, 'ModifyIndex': index}
+            for k, v in sorted(keys.items())]
+
+
+class DecodeTreeTestCase(unittest.TestCase):
+
+    def test_builds_nested_records(self):
+        tree = snapshot.decode_tree(DN, entries({
+            DN + '/status': 'registered',
+            DN + '/nodes/node0/mem': '1024',
+            DN + '/nodes/node0/disks/disk0/destination': '/data/0',
+            DN + '/nodes/node1/mem': '2048',
+            DN + '/services/seeds/nodes/node0': ''}))
+        self.assertEqual(tree.status, 'registered')
+        self.assertEqual([n.name for n in tree.subrecords('nodes')],
+                         ['node0', 'node1'])
+        node0 = tree.subrecords('nodes')[0]
+        self.assertEqual(node0.mem, '1024')
+        self.assertEqual(node0.dn, DN + '/nodes/node0')
+        disk = node0.subrecords('disks')[0]
+        self.assertEqual(disk.destination, '/data/0')
+        seeds = tree.subrecords('services')[0]
+        self.assertEqual([n.name for n in seeds.subrecords('nodes')], ['node0'])
+
+    def test_folder_keys_add_no_records(self):
+        tree = snapshot.decode_tree(DN, entries({
+            DN + '/': '',
+            DN + '/nodes/': '',
+            DN + '/services/': '',
+            DN + '/nodes/node0/mem': '1024'}))
+        self.assertEqual([n.name for n in tree.subrecords('nodes')], ['node0'])
+        self.assertEqual(tree.subrecords('services'), [])
+        self.assertEqual(tree.attributes, {})
+
+    def test_folder_keys_of_a_record_add_the_record(self):
+        tree = snapshot.decode_tree(DN, entries({
+            DN + '/nodes/node0/': '',
+            DN + '/nodes/node1/disks/': ''}))
+        nodes = tree.subrecords('nodes')
+        self.assertEqual([n.name for n in nodes], ['node0', 'node1'])
+        self.assertEqual(nodes[0].attributes, {})
+        self.assertEqual(nodes[1].subrecords('disks'), [])
+
+    def test_containers_skip_the_other_records(self):
+        keys = {DN + '/nodes/node0/mem': '1024',
+                DN + '/nodes/node0/disks/disk0/destination': '/data/0',
+                DN + '/nodes/node0/networks/eth0/address': '10.0.0.1',
+                DN + '/services/db/status': 'ready',
+                DN + '/services/db/nodes/node0': ''}
+        tree = snapshot.decode_tree(DN, entries(keys), ['nodes', 'nodes/disks'])
+        node0 = tree.subrecords('nodes')[0]
+        self.assertEqual(node0.mem, '1024')
+        self.assertEqual([d.name for d in node0.subrecords('disks')], ['disk0'])
+        self.assertEqual(node0.subrecords('networks'), [])
+        self.assertEqual(tree.subrecords('services'), [])
+        tree = snapshot.decode_tree(DN, entries(keys), ['services'])
+        self.assertEqual(tree.subrecords('nodes'), [])
+        service = tree.subrecords('services')[0]
+        self.assertEqual(service.status, 'ready')
+        self.assertEqual(service.subrecords('nodes'), [])
+
+    def test_index_is_the_highest_modify_index(self):
+        tree = snapshot.decode_tree(DN, [
+            {'Key': DN + '/status', 'Value': 'x', 'ModifyIndex': 7},
+            {'Key': DN + '/nodes/node0/mem', 'Value': '1', 'ModifyIndex': 9}])
+        self.assertEqual(tree.index, 9)
+
+    def test_missing_attributes_raise(self):
+        tree = snapshot.decode_tree(DN, [])
+        with self.assertRaises(registry.KeyDoesNotExist):
+            tree.status
+
+
+class DecodeClustersTestCase(unittest.TestCase):
+
+    def test_groups_entries_by_cluster(self):
+        clusters = list(snapshot.decode_clusters(entries({
+            'clusters/': '',
+            'clusters/test/': '',
+            DN + '/': '',
+            DN + '/status': 'running',
+            DN + '/nodes/node0/mem': '1',
+            'clusters/test/cassandra/3.0/2/status': 'destroyed'})))
+        self.assertEqual([c.dn for c in clusters],
+                         [DN, 'clusters/test/cassandra/3.0/2'])
+        self.assertEqual(clusters[0].attributes, {'status': 'running'})
+
+
+class LoadClusterTreeTestCase(ConsulTestCase):
+
+    def setUp(self):
+        super(LoadClusterTreeTestCase, self).setUp()
+        self.consul.put(DN + '/status', 'registered')
+        self.consul.put(DN + '/nodes/', '')
+        self.consul.put(DN + '/services/', '')
+        for node in ('node0', 'node1'):
+            self.consul.put('{}/nodes/{}/mem'.format(DN, node), '1024')
+            self.consul.put('{}/nodes/{}/disks/disk0/destination'.format(DN, node),
+                            '/data/0')
+            self.consul.put('{}/services/db/nodes/{}'.format(DN, node), '')
+
+    def test_nodes_match_the_registry(self):
+        tree = snapshot.load_cluster_tree('test', 'cassandra', '3.0', '1')
+        cluster = registry.get_cluster(dn=DN)
+        self.assertEqual([n.dn for n in tree.subrecords('nodes')],
+                         sorted(n.dn for n in cluster.nodes))
+        self.assertEqual([s.dn for s in tree.subrecords('services')],
+                         sorted(s.dn for s in cluster.services))
+
+    def test_missing_cluster(self):
+        with self.assertRaises(kvstore.KeyDoesNotExist):
+            snapshot.load_cluster_tree('test', 'cassandra', '3.0', '2')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+"""Tests for the pool of workers running the asynchronous requests"""
+import threading
+import time
+import unittest
+
+from app.workers import WorkerPool, PoolSaturatedError
+
+
+class WorkerPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = WorkerPool(workers=2, queue_size=2)
+
+    def run_all(self, functions):
+        done = threading.Semaphore(0)
+
+        def job(function):
+            def run():
+                try:
+                    function()
+                finally:
+                    done.release()
+            return run
+        for function in functions:
+            self.pool.submit(job(function))
+        for _ in functions:
+            done.acquire()
+
+    def wait_idle(self):
+        # The counters are updated right after the job returns
+        for _ in range(100):
+            info = self.pool.info()
+            if info['completed'] + info['failed'] == info['submitted']:
+                return info
+            time.sleep(0.01)
+        self.fail('the pool did not finish its jobs')
+
+    def test_counts_completed_and_failed_jobs(self):
+        def fail():
+            raise ValueError('failed')
+        # Room for all of them, the workers may not have started yet
+        self.pool = WorkerPool(workers=2, queue_size=3)
+        self.run_all([lambda: None, fail, lambda: None])
+        info = self.wait_idle()
+        self.assertEqual((info['submitted'], info['completed'], info['failed']),
+                         (3, 2, 1))
+        self.assertEqual(info['active'], 0)
+
+    def test_saturated_queue(self):
+        release = threading.Event()
+        started = threading.Semaphore(0)
+
+        def block():
+            started.release()
+            release.wait()
+        for _ in range(2):
+            self.pool.submit(block)
+        for _ in range(2):
+            started.acquire()
+        self.pool.submit(block)
+        self.pool.submit(block)
+        self.assertTrue(self.pool.full())
+        with self.assertRaises(PoolSaturatedError):
+            self.pool.submit(block)
+        self.pool.reject()
+        release.set()
+        info = self.wait_idle()
+        self.assertEqual((info['submitted'], info['rejected'], info['completed']),
+                         (4, 1, 4))
+
+    def test_retry_after(self):
+        self.assertEqual(self.pool.retry_after(), 1)
+        self.pool._durations.extend([4, 4])
+        # 4s per job, 2 workers, the new job waits for one job
+        self.assertEqual(self.pool.retry_after(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()